@@ -61,6 +61,21 @@ def parse_command_line():
             it were its own --query argument. So every sequence in
             --query-split will be run against every --blast-db.""")
 
+    group.add_argument(
+        '--jobs', type=int, default=1, metavar='N',
+        help="""How many blast DB and query pairs, or batches of queries, to
+            assemble at the same time. Their blast searches and assemblers
+            share the --cpus and the assembler's maximum memory.
+            (default %(default)s)""")
+
+    group.add_argument(
+        '--query-batch', type=int, default=1, metavar='N',
+        help="""Blast the queries in batches of this size. Each blast run
+            searches a shard for all of the queries in the batch, and the
+            queries go through their iterations together. This reads each
+            shard far fewer times with many --query-split sequences.
+            (default %(default)s)""")
+
     group.add_argument(
         '-o', '--output-prefix', required=True,
         help="""This is the prefix of all of the output files. So you can
@@ -210,6 +225,12 @@ def check_query_args(args, log):
         err = 'You must have at least one --query or --query-split argument.'
         log.fatal(err)
 
+    if args['query_batch'] < 1:
+        log.fatal('--query-batch must be at least 1.')
+
+    if args['jobs'] < 1:
+        log.fatal('--jobs must be at least 1.')
+
 
 def set_protein_arg(args):
     """Set up the protein argument."""
@@ -20,7 +20,7 @@ import lib.util as util
 from lib.core_preprocessor import preprocess
 
 
-def parse_command_line():
+def parse_command_line(argv=None):
     """Process command-line arguments."""
     description = """
         This script prepares data for use by the atram.py
@@ -139,17 +139,77 @@ def parse_command_line():
 
     group.add_argument(
         '--gzip', action='store_true',
-        help="""Are these gzip files?""")
+        help="""Are these gzip files? This is no longer needed. aTRAM detects
+            gzip, bzip2, xz, and zstd files from their contents.""")
 
     group.add_argument(
         '--bzip', action='store_true',
-        help="""Are these bzip files?""")
+        help="""Are these bzip files? This is no longer needed. aTRAM detects
+            gzip, bzip2, xz, and zstd files from their contents.""")
+
+    group.add_argument(
+        '--pipe-decompress', action='store_true',
+        help="""Decompress compressed files with an external program (like
+            pigz, pbzip2, xz, or zstd) in a separate process. This lets
+            decompressing and parsing run in parallel.""")
+
+    group.add_argument(
+        '--pack-seqs', action='store_true',
+        help="""Store the sequences in the database with 2 bits per base.
+            This makes the database much smaller.""")
+
+    group.add_argument(
+        '--read-ids', action='store_true',
+        help="""Replace the sequence names with integer read IDs in the
+            database and blast DB shards. The names are kept in a separate
+            table. This shrinks the database and speeds up atram.""")
+
+    group.add_argument(
+        '--batch-memory', type=int, metavar='MB', default=db.BATCH_MEMORY,
+        help="""Roughly how much memory, in megabytes, the batches of
+            sequences being loaded into the database may use. With
+            --parallel-load this is shared by all of the processes.
+            (default %(default)s)""")
+
+    group.add_argument(
+        '--dedup', action='store_true',
+        help="""Keep only one copy of reads (both ends of a pair) that have
+            identical sequences. The number of copies is stored with it.""")
+
+    group.add_argument(
+        '--cluster-seqs', action='store_true',
+        help="""Store the sequences sorted by name in a clustered table
+            instead of indexing them. Both ends of a read sit together so
+            atram reads them with less random I/O.""")
+
+    group.add_argument(
+        '--resume', action='store_true',
+        help="""Continue an interrupted run. Files that were completely
+            loaded and blast DB shards that were finished are skipped. Use
+            the same arguments as the interrupted run.""")
+
+    group.add_argument(
+        '--append', action='store_true',
+        help="""Add the sequences to an existing atram database. Only the new
+            sequences are put into new blast DB shards. The --shards option
+            is for the new sequences only.""")
 
     group.add_argument(
         '--shuffle', action='store_true',
         help="""Shuffle sequences before putting them into blast files?""")
 
-    args = vars(parser.parse_args())
+    group.add_argument(
+        '--parallel-load', action='store_true',
+        help="""Parse the input files with --cpus processes while loading
+            them into the database. Large uncompressed files are split into
+            chunks so they are parsed in parallel too.""")
+
+    group.add_argument(
+        '--stream-shards', action='store_true',
+        help="""Pipe the sequences for each blast DB shard straight into
+            makeblastdb instead of writing temporary fasta files.""")
+
+    args = vars(parser.parse_args(argv))
 
     # Prepend to PATH environment variable if requested
     if args['path']:
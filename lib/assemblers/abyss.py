@@ -67,6 +67,11 @@ class AbyssAssembler(BaseAssembler):
 
         copyfile(src, self.file['output'])
 
+    def resources(self):
+        """The CPUs and gigabytes of memory the assembler uses."""
+        return max(self.args.get('abyss_np') or 1,
+                   self.args.get('abyss_j') or 1), 0
+
     @staticmethod
     def command_line_args(parser):
         """Add command-line arguments for this assembler."""
@@ -26,6 +26,7 @@ class BaseAssembler:  # pylint: disable=too-many-public-methods
             'query_file': '',  # Current query file name
             'blast_db': '',  # Current blast DB name
             'iter_dir': '',  # Name of the temp dir for this iteration
+            'shards': {},  # Blast DB shards and their sizes
             'cxn': cxn}  # Save the DB connection
 
     def init_iteration(self, blast_db, query_file, iteration):
@@ -146,6 +147,10 @@ class BaseAssembler:  # pylint: disable=too-many-public-methods
     def post_assembly(self):
         """Handle unique post assembly steps."""
 
+    def resources(self):
+        """The CPUs and gigabytes of memory the assembler uses."""
+        return 1, 0
+
     @staticmethod
     def parse_contig_id(header):
         """Given a fasta header line from the assembler return contig ID."""
@@ -287,12 +292,3 @@ class BaseAssembler:  # pylint: disable=too-many-public-methods
         if self.file['single_any_count']:
             single_ends.append(self.file['single_any'])
         return single_ends
-
-    def simple_state(self):
-        """Save the state passed to subprocesses."""
-        return {
-            'blast_db': self.state['blast_db'],
-            'iteration': self.state['iteration'],
-            'query_file': self.state['query_file'],
-            'query_target': self.state['query_target'],
-            'iter_dir': self.state['iter_dir']}
@@ -55,6 +55,10 @@ class SpadesAssembler(BaseAssembler):
         src = join(self.work_path(), 'contigs.fasta')
         shutil.move(src, self.file['output'])
 
+    def resources(self):
+        """The CPUs and gigabytes of memory the assembler uses."""
+        return self.args['spades_threads'], self.args['spades_memory']
+
     @staticmethod
     def command_line_args(parser):
         """Add command-line arguments for this assembler."""
@@ -54,6 +54,10 @@ class TrinityAssembler(BaseAssembler):
         src = join(self.state['iter_dir'], 'trinity.Trinity.fasta')
         move(src, self.file['output'])
 
+    def resources(self):
+        """The CPUs and gigabytes of memory the assembler uses."""
+        return self.args['cpus'], self.args['trinity_max_memory']
+
     @staticmethod
     def command_line_args(parser):
         """Add command-line arguments for this assembler."""
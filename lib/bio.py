@@ -1,7 +1,9 @@
 """Utilities for working with sequences."""
 
 import re
+import struct
 
+import numpy as np
 from Bio import SeqIO
 
 CODON_LEN = 3
@@ -11,6 +13,14 @@ COMPLEMENT = str.maketrans('ACGTUWSMKRYBDHVNXacgtuwsmkrybdhvnx-',
 
 IS_PROTEIN = re.compile(r'[EFILPQ]', re.IGNORECASE)
 
+# 2-bit codes for packed sequences. Anything else is stored as an exception.
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+NOT_A_BASE = 255
+BASE_CODES = np.full(256, NOT_A_BASE, dtype=np.uint8)
+BASE_CODES[BASES] = np.arange(4, dtype=np.uint8)
+
+PACKED_HEADER = struct.Struct('<II')  # Sequence length, exception run count
+
 
 def reverse_complement(seq):
     """Reverse complement a nucleotide sequence. We added some wildcards."""
@@ -31,3 +41,162 @@ def fasta_file_has_protein(query_files):
                     return True
 
     return False
+
+
+def pack_seq(seq):
+    """Pack one nucleotide sequence into 2 bits per base (see pack_seqs)."""
+    return pack_seqs([seq])[0]
+
+
+def unpack_seq(blob):
+    """Unpack a sequence packed by pack_seq. Text is returned as is."""
+    return unpack_seqs([blob])[0]
+
+
+def pack_seqs(seqs):
+    """
+    Pack a batch of nucleotide sequences into 2 bits per base.
+
+    Runs of characters other than A, C, G, or T (like N or IUPAC codes) are
+    stored as exceptions before the packed bases. The layout is: the header,
+    the run starts (uint32), run lengths (uint32), run characters (uint8),
+    and then 4 bases per byte. The whole batch is encoded with a few numpy
+    operations and then cut into one blob per sequence.
+    """
+    if not seqs:
+        return []
+
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    starts = run_starts(lengths)
+    seq_of_char = np.repeat(np.arange(len(seqs)), lengths)
+
+    chars = np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8)
+    codes = BASE_CODES[chars]
+
+    # Runs of other characters. A run never crosses into the next sequence.
+    others = np.flatnonzero(codes == NOT_A_BASE)
+    codes[others] = 0
+    values = chars[others]
+    breaks = np.flatnonzero(
+        (np.diff(others) != 1) | (np.diff(values) != 0)
+        | (np.diff(seq_of_char[others]) != 0)) + 1
+    firsts = np.concatenate(([0], breaks)).astype(np.intp)
+    lasts = np.concatenate((breaks, [others.size])).astype(np.intp)
+    if not others.size:
+        firsts = lasts = firsts[:0]
+    run_seqs = seq_of_char[others[firsts]]
+    run_counts = np.bincount(run_seqs, minlength=len(seqs))
+
+    # Pad every sequence to a multiple of 4 bases and pack them
+    packed_sizes = (lengths + 3) // 4
+    packed_starts = run_starts(packed_sizes)
+    padded = np.zeros(4 * packed_sizes.sum(), dtype=np.uint8)
+    padded[np.arange(chars.size)
+           + np.repeat(4 * packed_starts - starts, lengths)] = codes
+    padded = padded.reshape(-1, 4)
+    packed = (padded[:, 0] << 6) | (padded[:, 1] << 4) \
+        | (padded[:, 2] << 2) | padded[:, 3]
+
+    # Scatter every part of every blob into one buffer
+    blob_sizes = PACKED_HEADER.size + 9 * run_counts + packed_sizes
+    blob_starts = run_starts(blob_sizes)
+    out = np.zeros(blob_sizes.sum(), dtype=np.uint8)
+
+    header = np.stack((lengths, run_counts), axis=1).astype('<u4')
+    out[blob_starts[:, None] + np.arange(PACKED_HEADER.size)] = \
+        header.view(np.uint8).reshape(-1, PACKED_HEADER.size)
+
+    first_runs = run_starts(run_counts)
+    run_index = np.arange(run_seqs.size) - first_runs[run_seqs]
+    run_at = blob_starts[run_seqs] + PACKED_HEADER.size
+    run_counts_at = run_counts[run_seqs]
+    put_u4(out, run_at + 4 * run_index, others[firsts] - starts[run_seqs])
+    put_u4(out, run_at + 4 * (run_counts_at + run_index), lasts - firsts)
+    out[run_at + 8 * run_counts_at + run_index] = values[firsts]
+
+    out[np.arange(packed.size) + np.repeat(
+        blob_starts + PACKED_HEADER.size + 9 * run_counts - packed_starts,
+        packed_sizes)] = packed
+
+    out = out.tobytes()
+    ends = (blob_starts + blob_sizes).tolist()
+    return [out[i:j] for i, j in zip(blob_starts.tolist(), ends)]
+
+
+def unpack_seqs(blobs):
+    """
+    Unpack a batch of sequences packed by pack_seqs.
+
+    The packed sequences are decoded together with a few numpy operations.
+    Text is returned as is.
+    """
+    packed_at = [i for i, b in enumerate(blobs) if isinstance(b, bytes)]
+    if not packed_at:
+        return list(blobs)
+
+    seqs = list(blobs)
+    packed_blobs = [blobs[i] for i in packed_at]
+
+    blob_sizes = np.array([len(b) for b in packed_blobs], dtype=np.int64)
+    blob_starts = run_starts(blob_sizes)
+    data = np.frombuffer(b''.join(packed_blobs), dtype=np.uint8)
+
+    header = data[blob_starts[:, None] + np.arange(PACKED_HEADER.size)]
+    header = header.view('<u4').astype(np.int64)
+    lengths, run_counts = header[:, 0], header[:, 1]
+    starts = run_starts(lengths)
+
+    # Decode the bases, dropping the padding at the end of every sequence
+    packed_sizes = (lengths + 3) // 4
+    packed_starts = run_starts(packed_sizes)
+    packed = data[np.arange(packed_sizes.sum()) + np.repeat(
+        blob_starts + PACKED_HEADER.size + 9 * run_counts - packed_starts,
+        packed_sizes)]
+    codes = np.stack((packed >> 6, packed >> 4, packed >> 2, packed), axis=1)
+    chars = BASES[codes.ravel()[np.arange(lengths.sum()) + np.repeat(
+        4 * packed_starts - starts, lengths)] & 3]
+
+    # Put the runs of other characters back
+    run_seqs = np.repeat(np.arange(len(packed_blobs)), run_counts)
+    run_index = np.arange(run_seqs.size) - run_starts(run_counts)[run_seqs]
+    run_at = blob_starts[run_seqs] + PACKED_HEADER.size
+    run_counts_at = run_counts[run_seqs]
+    run_firsts = get_u4(data, run_at + 4 * run_index) + starts[run_seqs]
+    run_lengths = get_u4(data, run_at + 4 * (run_counts_at + run_index))
+    run_values = data[run_at + 8 * run_counts_at + run_index]
+    chars[np.arange(run_lengths.sum()) + np.repeat(
+        run_firsts - run_starts(run_lengths), run_lengths)] = \
+        np.repeat(run_values, run_lengths)
+
+    text = chars.tobytes().decode('ascii')
+    ends = (starts + lengths).tolist()
+    for i, start, end in zip(packed_at, starts.tolist(), ends):
+        seqs[i] = text[start:end]
+
+    return seqs
+
+
+def run_starts(sizes):
+    """Get where each of the sizes starts when they are laid end to end."""
+    starts = np.zeros(len(sizes), dtype=np.int64)
+    np.cumsum(sizes[:-1], out=starts[1:])
+    return starts
+
+
+def put_u4(out, offsets, values):
+    """Write little endian uint32 values into a byte array at the offsets."""
+    out[offsets[:, None] + np.arange(4)] = \
+        values.astype('<u4').view(np.uint8).reshape(-1, 4)
+
+
+def get_u4(data, offsets):
+    """Read little endian uint32 values from a byte array at the offsets."""
+    raw = data[offsets[:, None] + np.arange(4)]
+    return raw.view('<u4').ravel().astype(np.int64)
+
+
+def seq_length(seq):
+    """Get the number of bases in a text or packed sequence."""
+    if isinstance(seq, bytes):
+        return PACKED_HEADER.unpack_from(seq)[0]
+    return len(seq)
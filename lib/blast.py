@@ -5,11 +5,15 @@ import json
 import os
 import re
 import sys
+import zlib
 from os.path import basename, dirname, join
 from shutil import which
 
 from . import util
 
+# The only blast hit fields we need for reading the SRA hits as tabular text
+TABULAR_FIELDS = 'qseqid stitle'
+
 
 def create_db(log, temp_dir, fasta_file, shard):
     """Create a blast database."""
@@ -18,8 +22,30 @@ def create_db(log, temp_dir, fasta_file, shard):
     log.subcommand(cmd, temp_dir)
 
 
-def against_sra(args, log, state, hits_file, shard):
-    """Blast the query sequences against an SRA blast database."""
+def create_db_from_records(log, temp_dir, records, shard):
+    """
+    Create a blast database by piping the records into makeblastdb.
+
+    The records are (seq_name, seq_end, seq) rows. This skips writing a
+    temporary fasta file.
+    """
+    cmd = 'makeblastdb -dbtype nucl -in - -title {} -out {}'
+    cmd = cmd.format(basename(shard), shard)
+
+    def feed(stdin):
+        for row in records:
+            util.write_fasta_record(stdin, row[0], row[2], row[1])
+
+    log.subcommand(cmd, temp_dir, feed=feed)
+
+
+def against_sra(args, log, state, hits_file, shards, db_size=None):
+    """
+    Blast the query sequences against a group of SRA blast DB shards.
+
+    The max target sequences is per shard so it grows with the group. The
+    db_size sets the database length used for the e-values.
+    """
     cmd = []
 
     if args['protein'] and state['iteration'] == 1:
@@ -29,15 +55,22 @@ def against_sra(args, log, state, hits_file, shard):
         cmd.append('blastn')
 
     cmd.append('-evalue {}'.format(args['blast_evalue']))
-    cmd.append('-outfmt 15')
-    cmd.append('-max_target_seqs {}'.format(args['blast_max_target_seqs']))
+    if args.get('blast_tabular'):
+        cmd.append('-outfmt "6 {}"'.format(TABULAR_FIELDS))
+    else:
+        cmd.append('-outfmt 15')
+    cmd.append('-max_target_seqs {}'.format(
+        int(args['blast_max_target_seqs'] * len(shards))))
     cmd.append('-out {}'.format(hits_file))
-    cmd.append('-db {}'.format(shard))
+    cmd.append('-db "{}"'.format(' '.join(shards)))
     cmd.append('-query {}'.format(state['query_file']))
 
     if args['blast_word_size']:
         cmd.append('-word_size {}'.format(args['blast_word_size']))
 
+    if db_size:
+        cmd.append('-dbsize {}'.format(db_size))
+
     command = ' '.join(cmd)
     log.subcommand(command, args['temp_dir'], timeout=args['timeout'])
 
@@ -64,24 +97,57 @@ def against_contigs(log, blast_db, query_file, hits_file, **kwargs):
     log.subcommand(command, kwargs['temp_dir'], timeout=kwargs['timeout'])
 
 
-def all_shard_paths(log, blast_db):
-    """Get all of the BLAST shard names built by the preprocessor."""
+def shard_path(blast_db, shard_index):
+    """Build the name of a BLAST shard."""
+    return '{}.{:03d}.blast'.format(blast_db, shard_index)
+
+
+def shard_paths(blast_db):
+    """Get the names of the BLAST shards that exist for the DB."""
     pattern = '{}.*.blast.nhr'.format(blast_db)
+    return sorted(f[:-4] for f in glob.glob(pattern))
+
+
+def shard_files_exist(shard):
+    """Check that makeblastdb wrote all of the shard's files."""
+    for ext in ('nhr', 'nin', 'nsq'):
+        path = '{}.{}'.format(shard, ext)
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return False
+    return True
+
+
+def shard_checksum(shard):
+    """
+    Get a CRC32 of the shard's index file.
+
+    makeblastdb rewrites the index with the offsets, sizes and build time of
+    the shard, so this changes whenever the shard is rebuilt.
+    """
+    checksum = 0
+    with open('{}.nin'.format(shard), 'rb') as index_file:
+        for chunk in iter(lambda: index_file.read(1 << 20), b''):
+            checksum = zlib.crc32(chunk, checksum)
+    return checksum
 
-    files = glob.glob(pattern)
+
+def all_shard_paths(log, blast_db):
+    """Get all of the BLAST shard names built by the preprocessor."""
+    files = shard_paths(blast_db)
     if not files:
-        err = ('No blast shards found. Looking for "{}"\n'
+        err = ('No blast shards found. Looking for "{}.*.blast"\n'
                'Verify the --work-dir and --file-prefix options.').format(
-            pattern[:-4])
+            blast_db)
         log.fatal(err)
 
-    return sorted(f[:-4] for f in files)
+    return files
 
 
-def output_file_name(temp_dir, shrd_path):
+def output_file_name(temp_dir, shrd_path, tabular=False):
     """Create a file name for blast results."""
     shard_name = basename(shrd_path)
-    file_name = '{}.results.json'.format(shard_name)
+    ext = 'tsv' if tabular else 'json'
+    file_name = '{}.results.{}'.format(shard_name, ext)
     return join(temp_dir, file_name)
 
 
@@ -91,8 +157,8 @@ def temp_db_name(temp_dir, blast_db):
     return join(temp_dir, file_name)
 
 
-def get_raw_hits(log, json_file):
-    """Extract the raw blast hits from the blast json output file."""
+def get_raw_searches(log, json_file):
+    """Extract the search for every query from the blast json output file."""
     with open(json_file) as blast_file:
         raw = blast_file.read()
 
@@ -108,13 +174,18 @@ def get_raw_hits(log, json_file):
                    'You may need to upgrade blast.')
             log.fatal(err)
 
-    return obj['BlastOutput2'][0]['report']['results']['search'].get('hits', [])
+    return [r['report']['results']['search'] for r in obj['BlastOutput2']]
 
 
-def hits(log, json_file):
-    """Extract the blast hits from the blast json output file."""
+def get_raw_hits(log, json_file):
+    """Extract the raw blast hits from the blast json output file."""
+    searches = get_raw_searches(log, json_file)
+    return searches[0].get('hits', []) if searches else []
+
+
+def expand_hits(raw_hits):
+    """Make a hit for every description of the raw blast hits."""
     hits_list = []
-    raw_hits = get_raw_hits(log, json_file)
 
     for raw in raw_hits:
         for i, desc in enumerate(raw['description']):
@@ -126,6 +197,43 @@ def hits(log, json_file):
     return hits_list
 
 
+def hits(log, json_file):
+    """Extract the blast hits from the blast json output file."""
+    return expand_hits(get_raw_hits(log, json_file))
+
+
+def hits_by_query(log, json_file):
+    """Extract the query title and blast hits of every query's search."""
+    for search in get_raw_searches(log, json_file):
+        yield search.get('query_title', ''), expand_hits(
+            search.get('hits', []))
+
+
+def tabular_hits(hits_file):
+    """
+    Read the query ID and hit title of the blast hits a line at a time.
+
+    There is a line for every HSP so we skip repeats of the line before to
+    get one hit for each sequence like the json output.
+    """
+    last = None
+    with open(hits_file) as blast_file:
+        for line in blast_file:
+            if line != last:
+                last = line
+                query_id, title = line.rstrip('\n').split('\t', 1)
+                yield query_id, title
+
+
+def first_query_id(query_file):
+    """Get the ID blast gives to the first sequence of the query file."""
+    with open(query_file) as in_file:
+        for line in in_file:
+            if line.startswith('>'):
+                return line[1:].split()[0] if line[1:].split() else ''
+    return ''
+
+
 def command_line_args(parser):
     """Add optional blast arguments to the command-line parser."""
     group = parser.add_argument_group('optional blast arguments')
@@ -148,6 +256,13 @@ def command_line_args(parser):
                             Default is calculated based on the available
                             memory and the number of shards.""")
 
+    group.add_argument('--blast-tabular', action='store_true',
+                       help="""Have blast write the hits against the blast DB
+                            shards as tabular text with only the fields aTRAM
+                            uses, instead of JSON. It is read a line at a
+                            time so it needs much less memory when a query
+                            has a huge number of hits.""")
+
     group.add_argument('--blast-batch-size', '--batch-size', type=int,
                        help="""Use this option to control blast memory usage
                             and the concatenation of queries. Setting this
@@ -1,16 +1,42 @@
 """Build assemblies using the aTRAM algorithm.."""
 
+import marshal
 import os
+import queue
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from itertools import groupby
+from operator import itemgetter
 from multiprocessing import Pool
 from os.path import basename, join, split, splitext
 from subprocess import TimeoutExpired
+from tempfile import mkstemp
 
 from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 
 from . import assembler as assembly, bio, blast, db, db_atram, util
 from .log import Logger
 
+# The arguments a blast worker needs. Everything else stays in this process.
+WORKER_ARGS = ('protein', 'blast_db_gencode', 'blast_evalue',
+               'blast_max_target_seqs', 'blast_word_size', 'blast_tabular',
+               'temp_dir', 'timeout', 'log_file', 'log_level')
+
+# Set up once in every worker process when the pool starts
+WORKER = {}
+
+# Tags each query sequence in a batch with the query it came from
+BATCH_TAG = 'atram_batch_'
+
+# How many blast hits to insert at once
+HIT_BATCH_SIZE = 10000
+
+# The CPUs and memory shared by jobs running at once. None for one job.
+BUDGET = None
+
 
 def assemble(args):
     """Loop thru every blast/query pair and run an assembly for each one."""
@@ -22,30 +48,218 @@ def assemble(args):
 
         queries = split_queries(args)
 
-        for blast_db in args['blast_db']:
-            with db.connect(blast_db, check_version=True) as cxn:
-                for query in queries:
-                    db.aux_db(cxn, args['temp_dir'], blast_db, query)
-                    clean_database(cxn)
+        jobs = assembly_jobs(args, queries)
+
+        with Pool(processes=args['cpus'],
+                  initializer=init_worker,
+                  initargs=({k: args[k] for k in WORKER_ARGS},)) as pool:
+            if args.get('jobs', 1) > 1:
+                assemble_jobs_at_once(args, pool, jobs)
+            else:
+                for job in jobs:
+                    assemble_job(args, pool, *job)
+
+
+def assembly_jobs(args, queries):
+    """
+    Split the work into jobs.
+
+    A job is a blast DB with either one query or one batch of queries. We
+    look up the shards of each blast DB once for all of its jobs.
+    """
+    log = Logger(args['log_file'], args['log_level'])
+    size = args.get('query_batch', 1)
+
+    jobs = []
+    for blast_db in args['blast_db']:
+        with db.connect(blast_db, check_version=True) as cxn:
+            shards = shard_manifest(log, cxn, blast_db)
+        cxn.close()
+        for start in range(0, len(queries), size):
+            jobs.append((blast_db, queries[start:start + size], shards))
+
+    return jobs
+
+
+def assemble_job(args, pool, blast_db, queries, shards):
+    """Run the assembly loops of one job."""
+    if args.get('query_batch', 1) > 1:
+        assemble_batch(args, pool, blast_db, queries, shards)
+    else:
+        cxn = db.connect(blast_db)
+        assemble_query(args, pool, cxn, blast_db, queries[0], shards)
+        cxn.close()
+
+
+def assemble_jobs_at_once(args, pool, jobs):
+    """
+    Run several jobs at the same time.
+
+    Each job runs in its own thread with its own database connection and aux
+    database. The shard searches and the assemblers of all of the jobs take
+    their CPUs and memory from one budget, so one job's search runs while
+    another one assembles without overloading the machine.
+    """
+    global BUDGET  # pylint: disable=global-statement
+
+    BUDGET = Budget(args['cpus'], args['max_memory'])
+    try:
+        with ThreadPoolExecutor(max_workers=args['jobs']) as threads:
+            for future in [threads.submit(assemble_job_in_thread,
+                                          args, pool, job) for job in jobs]:
+                future.result()
+    finally:
+        BUDGET = None
+
+
+def assemble_job_in_thread(args, pool, job):
+    """
+    Run a job in a thread. A fatal error only stops this job.
+
+    log.fatal has already logged its message but a plain sys.exit has not.
+    """
+    try:
+        assemble_job(args, pool, *job)
+    except SystemExit as err:
+        if not isinstance(err.code, int):
+            log = Logger(args['log_file'], args['log_level'])
+            log.error('The job for blast DB "{}" stopped: {}'.format(
+                job[0], err))
+
+
+class Budget:
+    """The CPUs and gigabytes of memory that the running jobs share."""
+
+    def __init__(self, cpus, memory):
+        self.total = {'cpus': cpus, 'memory': memory}
+        self.free = dict(self.total)
+        self.changed = threading.Condition()
+
+    def reserve(self, cpus, memory=0):
+        """
+        Wait until the CPUs and memory are free and take them.
+
+        A request for more than the whole budget gets the whole budget.
+        """
+        cpus = min(cpus, self.total['cpus'])
+        memory = min(memory, self.total['memory'])
+        with self.changed:
+            self.changed.wait_for(
+                lambda: self.free['cpus'] >= cpus
+                and self.free['memory'] >= memory)
+            self.free['cpus'] -= cpus
+            self.free['memory'] -= memory
+        return cpus, memory
+
+    def release(self, cpus, memory=0):
+        """Give the CPUs and memory back."""
+        with self.changed:
+            self.free['cpus'] += cpus
+            self.free['memory'] += memory
+            self.changed.notify_all()
+
+
+@contextmanager
+def reserved(cpus, memory=0):
+    """Hold CPUs and memory from the budget when jobs run at once."""
+    if not BUDGET:
+        yield
+        return
+    taken = BUDGET.reserve(cpus, memory)
+    try:
+        yield
+    finally:
+        BUDGET.release(*taken)
+
+
+def start_search(pool, state, shards, db_size, done):
+    """
+    Start the search of a shard group. It takes a CPU from the budget.
+
+    The hit rows, or the error, go on the done queue when it finishes.
+    """
+    if BUDGET:
+        BUDGET.reserve(1)
+
+    def finished(result):
+        if BUDGET:
+            BUDGET.release(1)
+        done.put(result)
+
+    pool.apply_async(
+        blast_query_against_one_shard, (state, shards, db_size),
+        callback=finished, error_callback=finished)
+
+
+def completed_searches(pool, state, groups, db_size):
+    """
+    Search all of the shard groups and yield the spooled hit rows of each
+    one as soon as it finishes.
+
+    The workers parse their own blast output so all we have to do here is
+    insert the rows while the slower searches are still running. If a search
+    fails we still wait for the others so they do not hold on to their CPUs
+    in the shared pool after we have moved on.
+    """
+    done = queue.Queue()
+
+    for shards in groups:
+        start_search(pool, state, shards, db_size, done)
+
+    pending = len(groups)
+    try:
+        while pending:
+            result = done.get()
+            pending -= 1
+            if isinstance(result, BaseException):
+                raise result
+            yield result
+    finally:
+        discard_searches(done, pending)
+
+
+def discard_searches(done, pending):
+    """Wait for the searches we will not use and remove their spool files."""
+    for _ in range(pending):
+        result = done.get()
+        if not isinstance(result, BaseException):
+            os.remove(result)
 
-                    log = Logger(args['log_file'], args['log_level'])
-                    log.header()
 
-                    assembler = assembly.factory(args, cxn, log)
+def assemble_query(args, pool, cxn, blast_db, query, shards):
+    """
+    Run the assembly loop for one blast DB and query pair.
+
+    All of the pairs use the same worker pool.
+    """
+    db.aux_db(cxn, args['temp_dir'], blast_db, query)
+    clean_database(cxn)
+
+    log = Logger(args['log_file'], args['log_level'])
+    log.header()
+
+    assembler = assembly.factory(args, cxn, log)
+    assembler.state['shards'] = shards
+
+    try:
+        assembly_loop(args, log, assembler, blast_db, query, pool)
+    except (TimeoutExpired, TimeoutError, RuntimeError):
+        pass
+    except Exception as err:  # pylint: disable=broad-except
+        log.error('Exception: {}'.format(err))
+    finally:
+        assembler.write_final_output(blast_db, query)
 
-                    try:
-                        assembly_loop(args, log, assembler, blast_db, query)
-                    except (TimeoutExpired, TimeoutError, RuntimeError):
-                        pass
-                    except Exception as err:  # pylint: disable=broad-except
-                        log.error('Exception: {}'.format(err))
-                    finally:
-                        assembler.write_final_output(blast_db, query)
+    db.aux_detach(cxn)
 
-                    db.aux_detach(cxn)
 
+def init_worker(worker_args):
+    """Keep the arguments and a log in the worker for all of its tasks."""
+    WORKER['args'] = worker_args
+    WORKER['log'] = Logger(worker_args['log_file'], worker_args['log_level'])
 
-def assembly_loop(args, log, assembler, blast_db, query):
+
+def assembly_loop(args, log, assembler, blast_db, query, pool):
     """Iterate over the assembly processes."""
     for iteration in range(1, assembler.args['iterations'] + 1):
         log.info('aTRAM blast DB = "{}", query = "{}", iteration {}'.format(
@@ -60,7 +274,7 @@ def assembly_loop(args, log, assembler, blast_db, query):
 
             assembler.setup_files(iter_dir)
 
-            query = assembly_loop_iteration(args, log, assembler)
+            query = assembly_loop_iteration(args, log, assembler, pool)
 
             if not query:
                 break
@@ -69,17 +283,22 @@ def assembly_loop(args, log, assembler, blast_db, query):
         log.info('All iterations completed')
 
 
-def assembly_loop_iteration(args, log, assembler):
+def assembly_loop_iteration(args, log, assembler, pool):
     """One iteration of the assembly loop."""
-    blast_query_against_all_shards(log, assembler)
+    blast_query_against_all_shards(log, assembler, pool)
+    return assemble_blast_hits(args, log, assembler)
+
 
+def assemble_blast_hits(args, log, assembler):
+    """Assemble the reads the blast hits found and make the next query."""
     count = assembler.count_blast_hits()
     if assembler.blast_only or count == 0:
         return False
 
     assembler.write_input_files()
 
-    assembler.run()
+    with reserved(*assembler.resources()):
+        assembler.run()
 
     if assembler.nothing_assembled():
         return False
@@ -97,6 +316,172 @@ def assembly_loop_iteration(args, log, assembler):
     return create_query_from_contigs(args, log, assembler)
 
 
+def assemble_batch(args, pool, blast_db, queries, shards):
+    """
+    Run the assembly loops of a batch of queries in lockstep.
+
+    Each query keeps its own aux database. In every iteration the current
+    query sequences of all of the queries still running are blasted against
+    each shard group at once, so each shard is read once for the batch. The
+    hits are split back out to the queries and then each query assembles its
+    reads as usual.
+    """
+    log = Logger(args['log_file'], args['log_level'])
+    assemblers = [start_batch_query(args, blast_db, q, shards)
+                  for q in queries]
+    running = dict(zip(assemblers, queries))
+
+    try:
+        for iteration in range(1, args['iterations'] + 1):
+            if not running:
+                break
+
+            with ExitStack() as stack:
+                batch_dir = stack.enter_context(util.make_temp_dir(
+                    where=args['temp_dir'],
+                    prefix='{}_batch_{:02d}_'.format(
+                        basename(blast_db), iteration),
+                    keep=args['keep_temp_dir']))
+
+                for assembler, query in running.items():
+                    assembler.log.info(
+                        'aTRAM blast DB = "{}", query = "{}", '
+                        'iteration {}'.format(
+                            blast_db, split(query)[1], iteration))
+                    assembler.init_iteration(blast_db, query, iteration)
+                    assembler.setup_files(stack.enter_context(
+                        util.make_temp_dir(
+                            where=args['temp_dir'],
+                            prefix=assembler.file_prefix(),
+                            keep=args['keep_temp_dir'])))
+
+                if not blast_batch_against_all_shards(
+                        log, list(running), batch_dir, pool):
+                    break
+
+                for assembler in list(running):
+                    query = batch_query_iteration(args, assembler)
+                    if query:
+                        running[assembler] = query
+                    else:
+                        del running[assembler]
+
+        else:
+            for assembler in running:
+                assembler.log.info('All iterations completed')
+
+    finally:
+        for assembler, query in zip(assemblers, queries):
+            assembler.write_final_output(blast_db, query)
+            db.aux_detach(assembler.state['cxn'])
+            assembler.state['cxn'].close()
+
+
+def start_batch_query(args, blast_db, query, shards):
+    """Give a query of a batch its own connection and aux database."""
+    cxn = db.connect(blast_db)
+    db.aux_db(cxn, args['temp_dir'], blast_db, query)
+    clean_database(cxn)
+
+    log = Logger(args['log_file'], args['log_level'])
+    log.header()
+
+    assembler = assembly.factory(args, cxn, log)
+    assembler.state['shards'] = shards
+    return assembler
+
+
+def batch_query_iteration(args, assembler):
+    """Finish one query's iteration after the batch's shard searches."""
+    try:
+        return assemble_blast_hits(args, assembler.log, assembler)
+    except (TimeoutExpired, TimeoutError, RuntimeError):
+        pass
+    except Exception as err:  # pylint: disable=broad-except
+        assembler.log.error('Exception: {}'.format(err))
+    return False
+
+
+def blast_batch_against_all_shards(log, assemblers, batch_dir, pool):
+    """
+    Blast the query sequences of a batch against the SRA databases.
+
+    Every query sequence is tagged with the index of its query and its own
+    index in that query. The hits go to the aux database of the query they
+    were found for. It returns False if the searches failed.
+    """
+    first = assemblers[0]
+    log.info('Blasting {} queries against shards: iteration {}'.format(
+        len(assemblers), first.state['iteration']))
+
+    all_shards = shard_fraction(first)
+    groups, db_size = group_shards(
+        first.state['shards'], all_shards, first.args['cpus'])
+
+    cxn = first.state['cxn']
+    state = {
+        'iteration': first.state['iteration'],
+        'query_file': write_batch_query(batch_dir, assemblers),
+        'iter_dir': batch_dir,
+        'is_single_end': db.is_single_end(cxn),
+        'read_ids': db.has_read_ids(cxn),
+        'batch': True}
+
+    try:
+        for spool_path in completed_searches(pool, state, groups, db_size):
+            hits = spooled_hit_rows(spool_path)
+            for index, rows in groupby(hits, key=itemgetter(0)):
+                insert_hit_rows(
+                    assemblers[index].state['cxn'],
+                    (row for _, row in rows))
+    except (TimeoutExpired, TimeoutError, RuntimeError):
+        return False
+    except Exception as err:  # pylint: disable=broad-except
+        log.error('Exception: {}'.format(err))
+        return False
+
+    log.info('All {} blast results completed'.format(len(groups)))
+    return True
+
+
+def write_batch_query(batch_dir, assemblers):
+    """Put the query sequences of the batch into one tagged fasta file."""
+    batch_query = join(batch_dir, 'batch_query.fasta')
+
+    with open(batch_query, 'w') as out_file:
+        for i, assembler in enumerate(assemblers):
+            with open(assembler.state['query_file']) as query_file:
+                records = SimpleFastaParser(query_file)
+                for j, (title, seq) in enumerate(records):
+                    util.write_fasta_record(
+                        out_file,
+                        '{}{}_{} {}'.format(BATCH_TAG, i, j, title),
+                        seq)
+
+    return batch_query
+
+
+def batch_hit_titles(log, args, output_file):
+    """
+    Get the query index and title of the blast hits of a batch.
+
+    Like a single query, we only use the hits of the first sequence of each
+    query.
+    """
+    if args.get('blast_tabular'):
+        hits = blast.tabular_hits(output_file)
+    else:
+        hits = ((query_title.split()[0], hit['title'])
+                for query_title, query_hits
+                in blast.hits_by_query(log, output_file)
+                for hit in query_hits)
+
+    for query_id, title in hits:
+        index, seq_index = query_id[len(BATCH_TAG):].split('_')
+        if seq_index == '0':
+            yield int(index), title
+
+
 def split_queries(args):
     """
     Create query target for every query and query-split file.
@@ -147,7 +532,7 @@ def clean_database(cxn):
     db_atram.create_assembled_contigs_table(cxn)
 
 
-def blast_query_against_all_shards(log, assembler):
+def blast_query_against_all_shards(log, assembler, pool):
     """
     Blast the query against the SRA databases.
 
@@ -157,60 +542,172 @@ def blast_query_against_all_shards(log, assembler):
     log.info('Blasting query against shards: iteration {}'.format(
         assembler.state['iteration']))
 
-    all_shards = shard_fraction(log, assembler)
+    all_shards = shard_fraction(assembler)
+    groups, db_size = group_shards(
+        assembler.state['shards'], all_shards, assembler.args['cpus'])
 
-    with Pool(processes=assembler.args['cpus']) as pool:
-        results = [pool.apply_async(
-            blast_query_against_one_shard,
-            (assembler.args, assembler.simple_state(), shard))
-            for shard in all_shards]
-        all_results = [result.get() for result in results]
+    cxn = assembler.state['cxn']
+    state = {k: assembler.state[k]
+             for k in ('iteration', 'query_file', 'iter_dir')}
+    state['is_single_end'] = db.is_single_end(cxn)
+    state['read_ids'] = db.has_read_ids(cxn)
 
-    insert_blast_results(
-        all_shards, assembler.args, assembler.simple_state(), log)
-    log.info('All {} blast results completed'.format(len(all_results)))
+    for spool_path in completed_searches(pool, state, groups, db_size):
+        insert_hit_rows(cxn, spooled_hit_rows(spool_path))
 
+    log.info('All {} blast results completed'.format(len(groups)))
 
-def insert_blast_results(all_shards, args, state, log):
-    """Add all blast results to the auxiliary  database."""
-    with db.connect(state['blast_db']) as cxn:
-        db.aux_db(
-            cxn,
-            args['temp_dir'],
-            state['blast_db'],
-            state['query_target'])
 
-        for shard in all_shards:
-            shard = basename(shard)
+def sra_hit_titles(log, args, output_file, query_file):
+    """
+    Get the titles of the blast hits for the first query sequence.
 
-            batch = []
-            output_file = blast.output_file_name(state['iter_dir'], shard)
-
-            hits = blast.hits(log, output_file)
-            is_single_end = db.is_single_end(cxn)
-            for hit in hits:
-                seq_name, seq_end = blast.parse_blast_title(
-                    hit['title'], is_single_end)
-                batch.append((state['iteration'], seq_end, seq_name, shard))
+    This matches the json output where we only read the first search. The
+    tabular output is read a line at a time.
+    """
+    if args.get('blast_tabular'):
+        query_id = blast.first_query_id(query_file)
+        return (title for hit_query_id, title
+                in blast.tabular_hits(output_file)
+                if hit_query_id == query_id)
+    return (hit['title'] for hit in blast.hits(log, output_file))
+
+
+def blast_hit_rows(titles, iteration, shard, is_single_end, read_ids):
+    """Turn the blast hit titles into rows for the blast hits table."""
+    for title in titles:
+        seq_name, seq_end = blast.parse_blast_title(title, is_single_end)
+        if read_ids:
+            seq_name = int(seq_name)
+        yield iteration, seq_end, seq_name, shard
+
+
+def insert_hit_rows(cxn, rows):
+    """Insert the blast hit rows a batch at a time to keep memory flat."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= HIT_BATCH_SIZE:
             db_atram.insert_blast_hit_batch(cxn, batch)
+            batch = []
+    db_atram.insert_blast_hit_batch(cxn, batch)
 
-        db.aux_detach(cxn)
 
+def blast_query_against_one_shard(state, shards, db_size=None):
+    """
+    Blast the query against one group of blast DB shards.
 
-def blast_query_against_one_shard(args, state, shard):
-    """Blast the query against one blast DB shard."""
-    log = Logger(args['log_file'], args['log_level'])
-    output_file = blast.output_file_name(state['iter_dir'], shard)
-    blast.against_sra(args, log, state, output_file, shard)
+    It spools the hit rows for the blast hits table to a temp file and returns
+    its path. For a batch each row comes with the index of the query it was
+    found for. A log.fatal in here would only end this worker and the parent
+    would never hear back, so it is turned into a RuntimeError.
+    """
+    args, log = WORKER['args'], WORKER['log']
+    shard = basename(shards[0])
+
+    output_file = blast.output_file_name(
+        state['iter_dir'], shards[0], args.get('blast_tabular'))
+
+    try:
+        blast.against_sra(args, log, state, output_file, shards, db_size)
+
+        if state.get('batch'):
+            hits = batch_hit_titles(log, args, output_file)
+            rows = ((index, row)
+                    for index, titles in groupby(hits, key=itemgetter(0))
+                    for row in blast_hit_rows(
+                        (hit[1] for hit in titles), state['iteration'],
+                        shard, state['is_single_end'], state['read_ids']))
+        else:
+            titles = sra_hit_titles(
+                log, args, output_file, state['query_file'])
+            rows = blast_hit_rows(
+                titles, state['iteration'], shard,
+                state['is_single_end'], state['read_ids'])
+
+        return spool_hit_rows(rows, state['iter_dir'])
+    except SystemExit:
+        msg = 'The blast search of shard "{}" failed'.format(shard)
+        log.error(msg)
+        raise RuntimeError(msg)
+
+
+def spool_hit_rows(rows, spool_dir):
+    """Write the hit rows to a temp file a batch at a time."""
+    handle, spool_path = mkstemp(suffix='.spool', dir=spool_dir)
+
+    with open(handle, 'wb') as spool:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= HIT_BATCH_SIZE:
+                marshal.dump(batch, spool)
+                batch = []
+        marshal.dump(batch, spool)
+
+    return spool_path
+
+
+def spooled_hit_rows(spool_path):
+    """Read back the hit rows a worker spooled and then remove the file."""
+    with open(spool_path, 'rb') as spool:
+        while True:
+            try:
+                batch = marshal.load(spool)
+            except EOFError:
+                break
+            yield from batch
+
+    os.remove(spool_path)
+
+
+def group_shards(manifest, shards, cpus):
+    """
+    Group the shards into one balanced unit of work per CPU.
+
+    The preprocessor may build many more shards than we have CPUs. When it
+    recorded their sizes we give each blast run a group of shards with about
+    the same number of bases. The database size for the e-values is then set
+    to the mean shard size so the results do not depend on the grouping.
+    """
+    sizes = [manifest[s]['bases'] if manifest[s] else None for s in shards]
+
+    if len(shards) <= cpus or None in sizes:
+        return [[s] for s in shards], None
+
+    groups = [[] for _ in range(cpus)]
+    loads = [0] * cpus
+    by_size = sorted(
+        shards, key=lambda s: manifest[s]['bases'], reverse=True)
+    for shard in by_size:
+        smallest = loads.index(min(loads))
+        groups[smallest].append(shard)
+        loads[smallest] += manifest[shard]['bases']
+
+    db_size = sum(loads) // len(shards)
+    return [sorted(g) for g in groups], db_size
+
+
+def shard_manifest(log, cxn, blast_db):
+    """
+    Get the blast DB shards once for all of the queries.
+
+    We fall back to looking for the shard files for databases built before
+    the preprocessor recorded the shards.
+    """
+    manifest = db.get_shard_manifest(cxn, blast_db)
+    if not manifest:
+        manifest = {s: None for s in blast.all_shard_paths(log, blast_db)}
+    return manifest
 
 
-def shard_fraction(log, assembler):
+def shard_fraction(assembler):
     """
     Get the shards we are using.
 
     We may not want the entire DB for highly redundant libraries.
     """
-    all_shards = blast.all_shard_paths(log, assembler.state['blast_db'])
+    all_shards = list(assembler.state['shards'])
     last_index = int(len(all_shards) * assembler.args['fraction'])
     return all_shards[:last_index]
 
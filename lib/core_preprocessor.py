@@ -4,17 +4,43 @@ It takes sequence read archive (SRA) files and converts them into coordinated
 blast and sqlite3 databases.
 """
 
+import marshal
 import multiprocessing
+import os
+import resource
 import sys
-from os.path import basename, join, splitext
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from glob import glob
+from os.path import basename, exists, getsize, join, splitext
+from shutil import move
+from tempfile import mkstemp
 
 import numpy as np
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
-from . import blast, db, db_preprocessor, util
+from . import bio, blast, db, db_preprocessor, util
 from .log import Logger
 
+# The input files and how we clamp their sequence ends
+END_TYPES = [('mixed_ends', ''), ('end_1', '1'),
+             ('end_2', '2'), ('single_ends', '')]
+
+INGEST_CHUNK_SIZE = 2 ** 27  # Bytes of an uncompressed file per load job
+
+PACK_CHUNK_SIZE = 2 ** 20  # Bases to pack at once with --pack-seqs
+
+# Split shards by sequence count when the longest sequence is at most this
+# many times the length of the shortest one
+UNIFORM_LENGTH_RATIO = 1.1
+
+# The worker pool every library in a batch uses. None outside of a batch.
+SHARED_POOL = None
+
 
 def preprocess(args):
     """Build the databases required by atram."""
@@ -27,57 +53,427 @@ def preprocess(args):
             keep=args['keep_temp_dir']) as temp_dir:
         util.update_temp_dir(temp_dir, args)
 
-        with db.connect(args['blast_db'], clean=True) as cxn:
-            db_preprocessor.create_metadata_table(cxn, args)
+        if args.get('append'):
+            append_seqs(args, log)
+            return
+
+        db_name = db.get_db_name(args['blast_db'])
+        args['resume'] = args.get('resume') and exists(db_name)
+
+        with db.connect(args['blast_db'], clean=not args['resume']) as cxn:
+            if args['resume']:
+                use_resumed_settings(args, cxn, log)
+
+            db.bulk_load_setup(cxn)
+
+            if not args['resume']:
+                db_preprocessor.create_metadata_table(cxn, args)
+                db_preprocessor.create_sequences_table(
+                    cxn, args.get('read_ids'))
+            db_preprocessor.create_checkpoints_table(cxn)
 
-            db_preprocessor.create_sequences_table(cxn)
-            load_seqs(args, cxn, log)
+            shard_files = None
+            if shard_while_loading(args):
+                shard_files = open_shard_fastas(args, args['shard_count'])
 
-            log.info('Creating an index for the sequence table')
-            db_preprocessor.create_sequences_index(cxn)
+            load_seqs(args, cxn, log, shard_files)
+
+            if shard_files:
+                pool = open_pool(args)
+                pending = start_shard_builds(args, log, pool, shard_files)
+
+            if args.get('dedup') and not finished(args, cxn, 'dedup'):
+                dedup_seqs(args, cxn, log, 0)
+                db_preprocessor.add_checkpoint(cxn, 'dedup')
+
+            if args.get('read_ids') and not finished(args, cxn, 'read_ids'):
+                log.info('Assigning read IDs')
+                db_preprocessor.create_read_names_table(cxn)
+                db_preprocessor.assign_read_ids(cxn, 0)
+                db_preprocessor.add_checkpoint(cxn, 'read_ids')
+
+            if not finished(args, cxn, 'indexed'):
+                index_seqs(args, cxn, log)
 
             if not args['shuffle']:
                 shard_list = assign_seqs_to_shards(
                     cxn, log, args['shard_count'])
 
-        if args['shuffle']:
+            log.info('Analyzing and checking the database')
+            db.finish_bulk_load(cxn)
+
+        if shard_files:
+            finish_shard_builds(cxn, log, pool, pending)
+        elif args['shuffle'] and args.get('stream_shards'):
             create_all_shuffled_shards(args, cxn, log, args['shard_count'])
+        elif args['shuffle']:
+            create_all_hashed_shards(args, cxn, log, args['shard_count'])
         else:
-            create_all_shards(args, log, shard_list)
+            create_all_shards(args, cxn, log, shard_list)
+
+
+def shard_while_loading(args):
+    """
+    Can we write the shuffled shards' fasta files while loading sequences.
+
+    Only when the rows we load are the final ones. Read IDs and removing
+    duplicates change them after loading and when resuming we don't see
+    the rows that were loaded before.
+    """
+    return (args['shuffle'] and not args.get('stream_shards')
+            and not args.get('read_ids') and not args.get('dedup')
+            and not args.get('resume'))
+
+
+def index_seqs(args, cxn, log):
+    """Either index the sequences table or cluster it on the sequence name."""
+    if args.get('cluster_seqs'):
+        # A resumed run may have been stopped after the table was clustered
+        if not db_preprocessor.sequences_table_is_clustered(cxn):
+            log.info('Clustering the sequence table by sequence name')
+            db_preprocessor.cluster_sequences_table(cxn, args.get('dedup'))
+    else:
+        log.info('Creating an index for the sequence table')
+        db_preprocessor.create_sequences_index(cxn)
+    db_preprocessor.add_checkpoint(cxn, 'indexed')
+
+
+def use_resumed_settings(args, cxn, log):
+    """Use the settings the database we are resuming was built with."""
+    log.info('Resuming the build of "{}"'.format(args['blast_db']))
+    db.check_versions(cxn)
+    db.check_integrity(cxn)
+    args['pack_seqs'] = db.is_packed(cxn)
+    args['read_ids'] = db.has_read_ids(cxn)
+    args['cluster_seqs'] = db.is_clustered(cxn)
+    args['dedup'] = db.is_deduped(cxn)
+    args['shard_count'] = int(db.get_metadata(
+        cxn, 'shard_count', default=args['shard_count']))
+
+
+def finished(args, cxn, step):
+    """Did the run we are resuming already finish this step."""
+    if not args.get('resume'):
+        return False
+    return bool(db_preprocessor.get_checkpoints(cxn, step))
+
+
+def append_seqs(args, log):
+    """
+    Add sequences to an existing atram database.
+
+    The new sequences are appended to the sequences table and only they go
+    into the new blast shards. The existing shards are left alone.
+    """
+    with db.connect(args['blast_db'], check_version=True) as cxn:
+        if db.is_single_end(cxn) != bool(args.get('single_ends')):
+            log.fatal('You cannot mix single and paired ends in a database.')
+        if db.is_clustered(cxn):
+            log.fatal('You cannot append to a clustered database.')
+
+        # New sequences are stored the same way as the old ones
+        args['pack_seqs'] = db.is_packed(cxn)
+        args['read_ids'] = db.has_read_ids(cxn)
+        db_preprocessor.create_checkpoints_table(cxn)
+        db_preprocessor.add_seq_len_column(cxn)
+
+        last_rowid = db_preprocessor.get_max_rowid(cxn)
+        load_seqs(args, cxn, log)
 
+        if args.get('dedup'):
+            dedup_seqs(args, cxn, log, last_rowid)
+            db_preprocessor.update_metadata(cxn, 'dedup', True)
 
-def load_seqs(args, cxn, log):
-    """Load sequences from a fasta/fastq files into the atram database."""
+        if args['read_ids']:
+            log.info('Assigning read IDs')
+            db_preprocessor.assign_read_ids(cxn, last_rowid)
+
+        shard_list = assign_new_seqs_to_shards(
+            cxn, log, last_rowid, args['shard_count'])
+
+        old_count = len(blast.shard_paths(args['blast_db']))
+        add_old_shards_to_manifest(args, cxn)
+
+        getter = db_preprocessor.get_sequences_in_rowid_range
+        if args.get('stream_shards'):
+            stream_blast_shards(
+                args, cxn, log, getter, shard_list, first_shard=old_count + 1)
+        else:
+            build_blast_shards(
+                args, cxn, log, getter, shard_list, first_shard=old_count + 1)
+
+        db_preprocessor.update_metadata(
+            cxn, 'shard_count', old_count + len(shard_list))
+
+
+def add_old_shards_to_manifest(args, cxn):
+    """
+    List the shards of a database built before we recorded them.
+
+    Otherwise atram would only see the new shards. Their sizes are unknown.
+    """
+    if db.get_shard_manifest(cxn, args['blast_db']):
+        return
+    for shard in blast.shard_paths(args['blast_db']):
+        db_preprocessor.add_shard_to_manifest(
+            cxn, shard, None, None, blast.shard_checksum(shard))
+
+
+def dedup_seqs(args, cxn, log, last_rowid):
+    """Collapse the duplicate templates loaded after last_rowid."""
+    log.info('Collapsing duplicate reads')
+    db_preprocessor.add_copies_column(cxn)
+    db_preprocessor.aux_db(cxn, args['temp_dir'])
+    removed = db_preprocessor.collapse_duplicates(cxn, last_rowid)
+    db_preprocessor.aux_detach(cxn)
+    log.info('Removed {} duplicate templates'.format(removed))
+
+
+def input_files(args):
+    """List the input files with their end types and end clamps."""
     # We have to clamp the end suffix depending on the file type.
-    for (ends, clamp) in [('mixed_ends', ''), ('end_1', '1'),
-                          ('end_2', '2'), ('single_ends', '')]:
-        if args.get(ends):
-            for file_name in args[ends]:
-                load_one_file(args, cxn, log, file_name, ends, clamp)
+    files = []
+    for (ends, clamp) in END_TYPES:
+        for file_name in args.get(ends) or []:
+            files.append((file_name, ends, clamp))
+    return files
+
+
+def load_seqs(args, cxn, log, shard_files=None):
+    """
+    Load sequences from a fasta/fastq files into the atram database.
+
+    When resuming, we skip the files that were completely loaded and remove
+    the rows of any file that was only partly loaded. If we're given the
+    shard fasta files then every sequence is also written to its shard.
+    """
+    files = input_files(args)
+
+    if args.get('resume'):
+        loaded = db_preprocessor.get_checkpoints(cxn, 'loaded')
+        files = [f for f in files if f[0] not in loaded]
+        if files:  # Clustered tables have no row IDs once every file is in
+            last_rowid = max(loaded.values(), default=0)
+            db_preprocessor.delete_sequences_after(cxn, last_rowid)
 
+    first_rowid = db_preprocessor.get_max_rowid(cxn) if files else 0
+    started = time.time()
 
-def load_one_file(args, cxn, log, file_name, ends, seq_end_clamp=''):
+    try:
+        if args.get('parallel_load'):
+            load_seqs_in_parallel(args, cxn, log, files, shard_files)
+        else:
+            for file_name, ends, clamp in files:
+                load_one_file(
+                    args, cxn, log, file_name, ends, clamp, shard_files)
+                file_loaded(cxn, file_name)
+    except OSError as err:  # Raised in a worker when a file is unreadable
+        log.fatal(str(err))
+
+    if files:
+        log_load_rate(cxn, log, first_rowid, started)
+
+
+def log_load_rate(cxn, log, first_rowid, started):
+    """Report how fast we loaded the sequences and our peak memory use."""
+    count = db_preprocessor.get_max_rowid(cxn) - first_rowid
+    elapsed = max(time.time() - started, 1e-6)
+
+    # On Linux the peak resident set size is in KiB
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    log.info(('Loaded {} sequences in {:.1f} seconds ({:.0f} per second). '
+              'Peak memory use was {} MB').format(
+                  count, elapsed, count / elapsed, peak >> 10))
+
+
+def file_loaded(cxn, file_name):
+    """Record that the file is completely loaded and where its rows end."""
+    last_rowid = db_preprocessor.get_max_rowid(cxn)
+    db_preprocessor.add_checkpoint(cxn, 'loaded', file_name, last_rowid)
+
+
+def load_one_file(
+        args, cxn, log, file_name, ends, seq_end_clamp='', shard_files=None):
     """Load sequences from a fasta/fastq file into the atram database."""
     log.info('Loading "{}" into sqlite database'.format(file_name))
 
     parser = get_parser(args, file_name)
 
     with util.open_file(args, file_name) as sra_file:
-        batch = []
+        records = parse_records(args, parser(sra_file), ends, seq_end_clamp)
+        for batch in byte_batches(records, batch_memory(args)):
+            insert_batch(cxn, batch, shard_files)
+
+
+def insert_batch(cxn, batch, shard_files=None):
+    """Insert a batch into the database and write it to the shard files."""
+    db_preprocessor.insert_sequences_batch(cxn, batch)
+    if shard_files:
+        write_hashed_shards(
+            db_preprocessor.unpack_rows(batch), shard_files)
+
 
-        for rec in parser(sra_file):
-            title = rec[0].strip()
-            seq = rec[1]
+def parse_records(args, records, ends, seq_end_clamp):
+    """
+    Convert parsed FASTA/Q records into sequence table rows.
+
+    The rows have the length of the sequence for balancing the shards.
+    Packed sequences are packed a chunk of records at a time because that is
+    much faster than packing them one by one.
+    """
+    for chunk in record_chunks(records, PACK_CHUNK_SIZE):
+        seqs = [rec[1] for rec in chunk]
+        if args.get('pack_seqs'):
+            seqs = bio.pack_seqs(seqs)
+        for rec, seq in zip(chunk, seqs):
             seq_name, seq_end = blast.parse_fasta_title(
-                title, ends, seq_end_clamp)
+                rec[0].strip(), ends, seq_end_clamp)
+            yield seq_name, seq_end, seq, len(rec[1])
+
 
-            batch.append((seq_name, seq_end, seq))
+def record_chunks(records, max_bases):
+    """Group the records into lists with about max_bases bases in each."""
+    chunk = []
+    bases = 0
+    for rec in records:
+        chunk.append(rec)
+        bases += len(rec[1])
+        if bases >= max_bases:
+            yield chunk
+            chunk = []
+            bases = 0
 
-            if len(batch) >= db.BATCH_SIZE:
-                db_preprocessor.insert_sequences_batch(cxn, batch)
-                batch = []
+    if chunk:
+        yield chunk
 
-        db_preprocessor.insert_sequences_batch(cxn, batch)
+
+def batch_memory(args, share=1):
+    """Get the bytes each batch may use when "share" batches are in memory."""
+    megabytes = args.get('batch_memory') or db.BATCH_MEMORY
+    return (megabytes << 20) // share
+
+
+def byte_batches(rows, max_bytes):
+    """
+    Group the rows into batches that use about max_bytes of memory.
+
+    So long reads give small batches and short reads give big ones. The same
+    list is reused for every batch, so the caller must be finished with a
+    batch before asking for the next one.
+    """
+    batch = []
+    size = 0
+    for row in rows:
+        batch.append(row)
+        size += len(row[0]) + len(row[2]) + db.BATCH_ROW_OVERHEAD
+        if size >= max_bytes:
+            yield batch
+            batch.clear()
+            size = 0
+
+    if batch:
+        yield batch
+
+
+def load_seqs_in_parallel(args, cxn, log, files, shard_files=None):
+    """
+    Parse the input files in worker processes and insert the rows here.
+
+    A load job is either a whole file or a byte range of a large uncompressed
+    file. The workers spool their parsed batches to the temp directory and we
+    insert them in job order, so records keep their per-file order. Only a
+    few jobs are in flight at once to keep the spool small.
+    """
+    jobs = ingest_jobs(args, files)
+    log.info('Loading {} jobs into sqlite database with {} processes'.format(
+        len(jobs), args['cpus']))
+
+    with worker_pool(args) as pool:
+        pending = deque()
+        loading = None
+
+        for job in jobs:
+            pending.append(pool.apply_async(parse_ingest_job, (args, job)))
+            if len(pending) > 2 * args['cpus']:
+                loading = insert_spooled_batches(
+                    log, cxn, pending.popleft().get(), loading, shard_files)
+
+        while pending:
+            loading = insert_spooled_batches(
+                log, cxn, pending.popleft().get(), loading, shard_files)
+
+    if loading:
+        file_loaded(cxn, loading)
+
+
+def ingest_jobs(args, files):
+    """Split the input files into load jobs.
+
+    Compressed files cannot be split so they are always one job.
+    """
+    jobs = []
+    for file_name, ends, clamp in files:
+        file_size = getsize(file_name)
+        compressed = util.compression_type(file_name)
+        if compressed or file_size <= INGEST_CHUNK_SIZE:
+            jobs.append((file_name, ends, clamp, None, None))
+            continue
+        for start in range(0, file_size, INGEST_CHUNK_SIZE):
+            end = min(start + INGEST_CHUNK_SIZE, file_size)
+            jobs.append((file_name, ends, clamp, start, end))
+    return jobs
+
+
+def parse_ingest_job(args, job):
+    """Parse one load job and spool the sequence batches to a temp file."""
+    file_name, ends, clamp, start, end = job
+    parser = get_parser(args, file_name)
+
+    if start is None:
+        stream = util.open_file(args, file_name)
+    else:
+        is_fastq = util.is_fastq_file(args, file_name)
+        stream = util.open_file_range(file_name, start, end, is_fastq)
+
+    handle, spool_path = mkstemp(suffix='.spool', dir=args['temp_dir'])
+
+    # Every worker and the process inserting the rows hold a batch
+    max_bytes = batch_memory(args, share=args['cpus'] + 1)
+
+    with open(handle, 'wb') as spool, stream as sra_file:
+        records = parse_records(args, parser(sra_file), ends, clamp)
+        for batch in byte_batches(records, max_bytes):
+            marshal.dump(batch, spool)
+
+    return file_name, spool_path
+
+
+def insert_spooled_batches(log, cxn, result, loading, shard_files=None):
+    """
+    Insert the batches a worker spooled and then remove the spool file.
+
+    The jobs for a file are inserted one after another. So when the file
+    changes the one we were loading is complete.
+    """
+    file_name, spool_path = result
+
+    if file_name != loading:
+        if loading:
+            file_loaded(cxn, loading)
+        log.info('Loading "{}" into sqlite database'.format(file_name))
+
+    with open(spool_path, 'rb') as spool:
+        while True:
+            try:
+                batch = marshal.load(spool)
+            except EOFError:
+                break
+            insert_batch(cxn, batch, shard_files)
+
+    os.remove(spool_path)
+    return file_name
 
 
 def get_parser(args, file_name):
@@ -87,15 +483,32 @@ def get_parser(args, file_name):
 
 
 def assign_seqs_to_shards(cxn, log, shard_count):
-    """Assign sequences to blast DB shards."""
+    """
+    Assign sequences to blast DB shards.
+
+    A shard's blast time depends on its number of bases, so the shards should
+    have the same number of bases. When the sequences are all about the same
+    length we can split them by count. Otherwise we split them by the running
+    total of bases in name order. The lengths were recorded while loading and
+    are in the sequences index, so neither way reads the sequences.
+    """
     log.info('Assigning sequences to shards')
 
-    total = db_preprocessor.get_sequence_count(cxn)
-    offsets = np.linspace(0, total - 1, dtype=int, num=shard_count + 1)
-    cuts = [db_preprocessor.get_shard_cut(cxn, offset) for offset in offsets]
+    shortest, longest, total_bases = db_preprocessor.get_length_range(cxn)
+
+    if longest and longest > shortest * UNIFORM_LENGTH_RATIO:
+        rows = db_preprocessor.get_lengths_in_name_order(cxn)
+        cuts, shard_bases = base_balanced_cuts(rows, total_bases, shard_count)
+        log_shard_spread(log, shard_bases)
+    else:
+        total = db_preprocessor.get_sequence_count(cxn)
+        offsets = np.linspace(0, total - 1, dtype=int, num=shard_count + 1)
+        cuts = db_preprocessor.get_shard_cuts(cxn, offsets)
+        log.info(('The sequences are {} to {} bases long so we split the '
+                  'shards by sequence count').format(shortest, longest))
 
     # Make sure the last sequence gets included
-    cuts[-1] += 'z'
+    cuts[-1] += 1 if isinstance(cuts[-1], int) else 'z'
 
     # Now organize the list into pairs of sequence names
     pairs = [(cuts[i - 1], cuts[i]) for i in range(1, len(cuts))]
@@ -103,96 +516,532 @@ def assign_seqs_to_shards(cxn, log, shard_count):
     return pairs
 
 
-def create_all_shards(args, log, shard_list):
-    """Assign processes to make the blast DBs.
+def base_balanced_cuts(rows, total_bases, shard_count):
+    """
+    Find the sequence names that split the bases evenly into shards.
 
-    One process for each blast DB shard.
+    The rows are the sequence names and lengths in name order. A shard starts
+    at the first name where the bases before it reach its share of the total.
+    Both ends of a read have the same name so they stay in one shard. We also
+    return the number of bases in each shard.
     """
-    log.info('Making blast DBs')
+    cuts = []
+    shard_bases = []
+    bases = 0
+    name = None
 
-    with multiprocessing.Pool(processes=args['cpus']) as pool:
-        results = []
-        for idx, shard_params in enumerate(shard_list, 1):
-            results.append(pool.apply_async(
-                create_one_blast_shard,
-                (args, shard_params, idx)))
+    for seq_name, length in rows:
+        if not cuts:
+            cuts.append(seq_name)
+            shard_bases.append(0)
+        elif seq_name != name and len(cuts) < shard_count \
+                and bases >= total_bases * len(cuts) / shard_count:
+            cuts.append(seq_name)
+            shard_bases.append(0)
+        name = seq_name
+        bases += length
+        shard_bases[-1] += length
 
-        all_results = [result.get() for result in results]
-    log.info('Finished making all {} blast DBs'.format(len(all_results)))
+    # Shards that we didn't reach start at the last name
+    while len(cuts) < shard_count:
+        cuts.append(name)
+        shard_bases.append(0)
+    cuts.append(name)
 
+    return cuts, shard_bases
+
+
+def log_shard_spread(log, shard_bases):
+    """Report how evenly the bases are split between the shards."""
+    mean = sum(shard_bases) / len(shard_bases)
+    spread = (max(shard_bases) - min(shard_bases)) / mean if mean else 0
+    log.info(('The shards have {} to {} bases each, a spread of {:.1%} of '
+              'the mean').format(min(shard_bases), max(shard_bases), spread))
 
-def create_all_shuffled_shards(args, cxn, log, shard_count):
-    """Assign processes to make the blast DBs.
 
-    One process for each blast DB shard.
+def assign_new_seqs_to_shards(cxn, log, last_rowid, shard_count):
     """
-    log.info('Making blast DBs')
+    Assign appended sequences to blast DB shards.
+
+    The appended sequences have the row IDs after the last one we had before
+    loading. So we split them by row ID range.
+    """
+    log.info('Assigning new sequences to shards')
+
+    max_rowid = db_preprocessor.get_max_rowid(cxn)
+    shard_count = max(1, min(shard_count, max_rowid - last_rowid))
+    cuts = np.linspace(last_rowid, max_rowid, dtype=int, num=shard_count + 1)
+
+    return [(int(cuts[i - 1]), int(cuts[i])) for i in range(1, len(cuts))]
+
+
+def create_all_shards(args, cxn, log, shard_list):
+    """Make the blast DBs from the sequence name ranges."""
+    getter = db_preprocessor.get_sequences_in_shard
+
+    if args.get('stream_shards'):
+        stream_blast_shards(args, cxn, log, getter, shard_list)
+    else:
+        build_blast_shards(args, cxn, log, getter, shard_list)
+
+
+def create_all_shuffled_shards(args, cxn, log, shard_count):
+    """Make the blast DBs from the shuffled sequences."""
     db_preprocessor.aux_db(cxn, args['temp_dir'])
     db_preprocessor.create_seq_names_table(cxn)
 
-    with multiprocessing.Pool(processes=args['cpus']) as pool:
-        results = []
-        for shard_idx in range(shard_count):
-            fasta_path = fill_shuffled_fasta(args, cxn, shard_count, shard_idx)
-            results.append(pool.apply_async(
-                create_one_shuffled_shard,
-                (args, fasta_path, shard_idx)))
+    getter = db_preprocessor.get_shuffled_sequences_in_shard
+    shard_list = [(shard_count, i) for i in range(shard_count)]
+
+    if args.get('stream_shards'):
+        stream_blast_shards(args, cxn, log, getter, shard_list)
+    else:
+        build_blast_shards(args, cxn, log, getter, shard_list)
 
-        all_results = [result.get() for result in results]
     db_preprocessor.aux_detach(cxn)
-    log.info('Finished making all {} blast DBs'.format(len(all_results)))
 
 
-def fill_shuffled_fasta(args, cxn, shard_count, shard_index):
-    """Fill the shard input files with sequences."""
-    exe_name, _ = splitext(basename(sys.argv[0]))
-    fasta_name = '{}_{:03d}.fasta'.format(exe_name, shard_index + 1)
-    fasta_path = join(args['temp_dir'], fasta_name)
+def unfinished_shards(args, cxn, shard_list, first_shard):
+    """
+    Number the shards and drop the ones that are already built.
 
-    with open(fasta_path, 'w') as fasta_file:
-        for row in db_preprocessor.get_shuffled_sequences_in_shard(
-                cxn, shard_count, shard_index):
-            util.write_fasta_record(fasta_file, row[0], row[2], row[1])
+    A shard is skipped when we are resuming, it was recorded as finished,
+    and its blast DB files are still there. Shards are recorded without their
+    directory so the blast DB may be moved or spelled differently.
+    """
+    done = set()
+    if args.get('resume'):
+        done = {basename(s) for s
+                in db_preprocessor.get_checkpoints(cxn, 'shard')}
 
-    return fasta_path
+    shards = []
+    for shard_index, shard_params in enumerate(shard_list, first_shard):
+        shard = blast.shard_path(args['blast_db'], shard_index)
+        if basename(shard) not in done \
+                or not blast.shard_files_exist(shard):
+            shards.append((shard_index, shard_params))
 
+    return shards
 
-def create_one_blast_shard(args, shard_params, shard_index):
-    """Create a blast DB from the shard.
 
-    We fill a fasta file with the appropriate sequences and hand things off
-    to the makeblastdb program.
+def build_blast_shards(args, cxn, log, getter, shard_list, first_shard=1):
     """
-    log = Logger(args['log_file'], args['log_level'])
+    Assign processes to make the blast DBs.
 
-    shard = '{}.{:03d}.blast'.format(args['blast_db'], shard_index)
+    This is a producer/consumer pipeline. We read the sequences for each shard
+    and write its fasta file here while the worker processes run makeblastdb
+    on the shards that are already written. A shard's makeblastdb starts as
+    soon as its fasta file is complete. We only let a few fasta files wait for
+    a worker, so the scratch space stays bounded.
+    """
+    log.info('Making blast DBs')
+
+    shards = unfinished_shards(args, cxn, shard_list, first_shard)
+
+    with worker_pool(args) as pool:
+        pending = deque()
+
+        for shard_index, shard_params in shards:
+            while len(pending) > args['cpus']:
+                shard_fasta_built(cxn, *pending.popleft())
+
+            rows = getter(cxn, *shard_params)
+            fasta = fill_shard_fasta(args, rows, shard_index)
+            pending.append((pool.apply_async(
+                create_one_blast_shard, (args, fasta.path, shard_index)),
+                fasta))
+
+        while pending:
+            shard_fasta_built(cxn, *pending.popleft())
+
+    log.info('Finished making all {} blast DBs'.format(len(shards)))
+
+
+def shard_built(cxn, shard, reads, bases):
+    """
+    Record that the blast DB shard is complete if makeblastdb worked.
+
+    Its size goes into the shard manifest so atram can balance its work.
+    """
+    if blast.shard_files_exist(shard):
+        db_preprocessor.add_checkpoint(cxn, 'shard', basename(shard))
+        db_preprocessor.add_shard_to_manifest(
+            cxn, shard, reads, bases, blast.shard_checksum(shard))
+
+
+def shard_fasta_built(cxn, result, fasta):
+    """Wait for the makeblastdb run on the shard's fasta file to finish."""
+    shard_built(cxn, result.get(), fasta.reads, fasta.bases)
+
+
+def shard_fasta_path(args, shard_index):
+    """Build the name of a shard's temporary fasta file."""
     exe_name, _ = splitext(basename(sys.argv[0]))
     fasta_name = '{}_{:03d}.fasta'.format(exe_name, shard_index)
-    fasta_path = join(args['temp_dir'], fasta_name)
+    return join(args['temp_dir'], fasta_name)
 
-    fill_blast_fasta(args['blast_db'], fasta_path, shard_params)
 
-    blast.create_db(log, args['temp_dir'], fasta_path, shard)
+class ShardFasta:
+    """A shard's temporary fasta file that counts the reads and bases in it."""
+
+    def __init__(self, args, shard_index):
+        self.shard_index = shard_index
+        self.path = shard_fasta_path(args, shard_index)
+        self.file = open(self.path, 'w')
+        self.reads = 0
+        self.bases = 0
+
+    def write(self, seq_name, seq_end, seq):
+        """Add a sequence to the shard."""
+        util.write_fasta_record(self.file, seq_name, seq, seq_end)
+        self.reads += 1
+        self.bases += len(seq)
 
+    def close(self):
+        """The shard is complete."""
+        self.file.close()
 
-def create_one_shuffled_shard(args, fasta_path, shard_index):
-    """Create a blast DB from the shard."""
+
+def fill_shard_fasta(args, rows, shard_index):
+    """Fill the shard input file with sequences."""
+    fasta = ShardFasta(args, shard_index)
+
+    for row in rows:
+        fasta.write(*row)
+
+    fasta.close()
+    return fasta
+
+
+def create_one_blast_shard(args, fasta_path, shard_index):
+    """
+    Create a blast DB from the shard.
+
+    We hand the filled fasta file off to the makeblastdb program and then
+    remove it to free up the scratch space.
+    """
     log = Logger(args['log_file'], args['log_level'])
-    shard = '{}.{:03d}.blast'.format(args['blast_db'], shard_index + 1)
+    shard = blast.shard_path(args['blast_db'], shard_index)
     blast.create_db(log, args['temp_dir'], fasta_path, shard)
 
+    if not args['keep_temp_dir']:
+        os.remove(fasta_path)
+
+    return shard
+
+
+def stream_blast_shards(args, cxn, log, getter, shard_list, first_shard=1):
+    """
+    Assign processes to make the blast DBs without temporary fasta files.
+
+    One process for each blast DB shard. Each one gets its sequences from the
+    DB with the getter function and pipes them straight into makeblastdb.
+    """
+    log.info('Making blast DBs')
+
+    shards = unfinished_shards(args, cxn, shard_list, first_shard)
+
+    with worker_pool(args) as pool:
+        results = []
+        for shard_index, shard_params in shards:
+            results.append(pool.apply_async(
+                stream_one_blast_shard,
+                (args, getter, shard_params, shard_index)))
+
+        for result in results:
+            shard_built(cxn, *result.get())
+
+    log.info('Finished making all {} blast DBs'.format(len(shards)))
+
+
+def stream_one_blast_shard(args, getter, shard_params, shard_index):
+    """Pipe the shard's sequences from the DB into makeblastdb."""
+    log = Logger(args['log_file'], args['log_level'])
+    shard = blast.shard_path(args['blast_db'], shard_index)
+
+    totals = [0, 0]
+
+    with db.connect(args['blast_db']) as cxn:
+        db_preprocessor.aux_db(cxn, args['temp_dir'])
+        rows = counted(getter(cxn, *shard_params), totals)
+        blast.create_db_from_records(log, args['temp_dir'], rows, shard)
+
+    return shard, totals[0], totals[1]
+
+
+def counted(rows, totals):
+    """Pass the rows through while adding up their reads and bases."""
+    for row in rows:
+        totals[0] += 1
+        totals[1] += len(row[2])
+        yield row
+
+
+# ########################## hashed shards ###################################
+
+def create_all_hashed_shards(args, cxn, log, shard_count):
+    """
+    Make the shuffled blast DBs from the database in one scan.
+
+    This is for when we could not write the shards while loading. When
+    resuming, only the unfinished shards are written.
+    """
+    log.info('Writing the sequences into {} shards by name hash'.format(
+        shard_count))
+
+    shards = unfinished_shards(args, cxn, [None] * shard_count, 1)
+    shard_files = open_shard_fastas(args, shard_count, [i for i, _ in shards])
+    write_hashed_shards(
+        db_preprocessor.get_all_shard_sequences(cxn), shard_files)
+
+    pool = open_pool(args)
+    pending = start_shard_builds(args, log, pool, shard_files)
+    finish_shard_builds(cxn, log, pool, pending)
+
+
+def open_shard_fastas(args, shard_count, shard_indexes=None):
+    """
+    Open the fasta files for shards that get their sequences by name hash.
+
+    There is a slot for every shard. The ones we don't need are None.
+    """
+    shard_indexes = set(shard_indexes or range(1, shard_count + 1))
+    return [ShardFasta(args, i) if i in shard_indexes else None
+            for i in range(1, shard_count + 1)]
+
+
+def hash_shard(seq_name, shard_count):
+    """Get a shard slot for the sequence name that is the same every run."""
+    return zlib.crc32(str(seq_name).encode()) % shard_count
+
+
+def write_hashed_shards(rows, shard_files):
+    """
+    Write the rows to the fasta files of their shards.
+
+    Both ends of a read have the same name so they go to the same shard. The
+    sequences must already be unpacked.
+    """
+    shard_count = len(shard_files)
+    for seq_name, seq_end, seq in rows:
+        fasta = shard_files[hash_shard(seq_name, shard_count)]
+        if fasta:
+            fasta.write(seq_name, seq_end, seq)
+
+
+def start_shard_builds(args, log, pool, shard_files):
+    """Close the shard fasta files and start a makeblastdb for each one."""
+    log.info('Making blast DBs')
+
+    pending = []
+    for fasta in shard_files:
+        if fasta:
+            fasta.close()
+            pending.append((pool.apply_async(
+                create_one_blast_shard,
+                (args, fasta.path, fasta.shard_index)), fasta))
+    return pending
+
+
+def finish_shard_builds(cxn, log, pool, pending):
+    """Wait for the makeblastdb runs and record the finished shards."""
+    for result, fasta in pending:
+        shard_fasta_built(cxn, result, fasta)
+
+    close_pool(pool)
+
+    log.info('Finished making all {} blast DBs'.format(len(pending)))
+
+
+# ########################## worker pools ####################################
+
+def open_pool(args):
+    """Use the batch's shared worker pool or start one for this library."""
+    return SHARED_POOL or multiprocessing.Pool(processes=args['cpus'])
+
+
+def close_pool(pool):
+    """Wait for the pool's work. The shared pool outlives the library."""
+    if pool is not SHARED_POOL:
+        pool.close()
+        pool.join()
+
+
+@contextmanager
+def worker_pool(args):
+    """Use the shared worker pool or a pool that ends with the block."""
+    if SHARED_POOL:
+        yield SHARED_POOL
+    else:
+        with multiprocessing.Pool(processes=args['cpus']) as pool:
+            yield pool
+
+
+def preprocess_batch(args, libraries):
+    """
+    Build the databases for many libraries with one shared worker pool.
+
+    A few libraries are built at once, each one in its own thread. The
+    threads only do the serial steps like inserting the rows and indexing.
+    The parsing and makeblastdb jobs of all of them go to the one pool. So
+    one library's load overlaps another one's shard builds without running
+    more than --cpus processes.
+    """
+    global SHARED_POOL  # pylint: disable=global-statement
+
+    log = Logger(args['log_file'], args['log_level'])
+    log.header()
+    log.info('Preprocessing {} libraries, {} at a time, with {} '
+             'processes'.format(len(libraries), args['libraries'],
+                                args['cpus']))
+
+    with multiprocessing.Pool(processes=args['cpus']) as pool:
+        SHARED_POOL = pool
+        try:
+            with ThreadPoolExecutor(max_workers=args['libraries']) as threads:
+                built = list(threads.map(preprocess_library, libraries))
+        finally:
+            SHARED_POOL = None
+
+    failed = [lib['blast_db'] for lib, ok in zip(libraries, built) if not ok]
+    if failed:
+        log.fatal('These libraries failed: {}'.format(', '.join(failed)))
+
+    log.info('Finished all {} libraries'.format(len(libraries)))
+
+
+def preprocess_library(args):
+    """Build one library of a batch and report if it worked."""
+    try:
+        preprocess(args)
+    except SystemExit:  # The library's log has the reason
+        return False
+    except Exception as err:  # pylint: disable=broad-except
+        log = Logger(args['log_file'], args['log_level'])
+        log.error('Exception: {}'.format(err))
+        return False
+    return True
+
+
+# ########################## resharding ######################################
+
+def reshard(args):
+    """
+    Rebuild the blast DB shards from the sequences already in the database.
+
+    We read the sequences table once and send every sequence to the fasta
+    file of its new shard. The new blast DBs are built in the temp directory
+    and they only replace the old shards after all of them are built.
+    """
+    log = Logger(args['log_file'], args['log_level'])
+    log.header()
+
+    with util.make_temp_dir(
+            where=args['temp_dir'],
+            prefix='atram_reshard_',
+            keep=args['keep_temp_dir']) as temp_dir:
+        util.update_temp_dir(temp_dir, args)
+
+        with db.connect(args['blast_db'], check_version=True) as cxn:
+            db_preprocessor.add_seq_len_column(cxn)
+
+            new_args = dict(args)
+            new_args['blast_db'] = join(temp_dir, basename(args['blast_db']))
+
+            with worker_pool(args) as pool:
+                if args['shuffle']:
+                    shards = reshard_by_hash(
+                        new_args, cxn, log, pool, args['shard_count'])
+                else:
+                    shards = reshard_by_range(
+                        new_args, cxn, log, pool, args['shard_count'])
+
+            replace_shards(args, cxn, log, shards)
 
-def fill_blast_fasta(blast_db, fasta_path, shard_params):
+
+def reshard_by_range(args, cxn, log, pool, shard_count):
     """
-    Fill the fasta file used as input into blast.
+    Split the sequences into shards by name range in one ordered scan.
 
-    Use sequences from the sqlite3 DB. We use the shard partitions passed in to
-    determine which sequences to get for this shard.
+    A shard's fasta file is complete once the scan moves past its range so
+    its makeblastdb starts right away.
     """
-    with db.connect(blast_db) as cxn:
-        limit, offset = shard_params
+    ends = [pair[1] for pair in assign_seqs_to_shards(cxn, log, shard_count)]
+
+    log.info('Writing the sequences into {} shards by name'.format(
+        shard_count))
+
+    pending = []
+    fasta = ShardFasta(args, 1)
+
+    for row in db_preprocessor.get_all_shard_sequences(cxn, ordered=True):
+        while row[0] >= ends[fasta.shard_index - 1]:
+            pending.append(start_reshard_build(args, pool, fasta))
+            fasta = ShardFasta(args, fasta.shard_index + 1)
+        fasta.write(*row)
+
+    pending.append(start_reshard_build(args, pool, fasta))
+
+    for shard_index in range(fasta.shard_index + 1, shard_count + 1):
+        fasta = ShardFasta(args, shard_index)
+        pending.append(start_reshard_build(args, pool, fasta))
+
+    return [(result.get(), f.reads, f.bases) for result, f in pending]
+
+
+def start_reshard_build(args, pool, fasta):
+    """Close the shard's fasta file and start its makeblastdb."""
+    fasta.close()
+    result = pool.apply_async(
+        create_one_blast_shard, (args, fasta.path, fasta.shard_index))
+    return result, fasta
+
+
+def reshard_by_hash(args, cxn, log, pool, shard_count):
+    """
+    Split the sequences into shards by a hash of their names in one scan.
+
+    All of the fasta files are open at once and they are only complete after
+    the scan.
+    """
+    log.info('Writing the sequences into {} shards by name hash'.format(
+        shard_count))
+
+    shard_files = open_shard_fastas(args, shard_count)
+    write_hashed_shards(
+        db_preprocessor.get_all_shard_sequences(cxn), shard_files)
+    pending = start_shard_builds(args, log, pool, shard_files)
+
+    return [(result.get(), f.reads, f.bases) for result, f in pending]
+
+
+def replace_shards(args, cxn, log, shards):
+    """
+    Swap the new blast DB shards in for the old ones.
+
+    The shards are (path, reads, bases) for each new shard.
+    """
+    missing = [s[0] for s in shards if not blast.shard_files_exist(s[0])]
+    if missing:
+        log.fatal('makeblastdb failed for "{}". The old blast DB shards were '
+                  'kept.'.format(missing[0]))
+
+    log.info('Replacing the blast DB shards')
+
+    for shard in blast.shard_paths(args['blast_db']):
+        for path in glob(shard + '.*'):
+            os.remove(path)
+
+    db_preprocessor.create_checkpoints_table(cxn)
+    db_preprocessor.delete_checkpoints(cxn, 'shard')
+    db_preprocessor.delete_shard_manifest(cxn)
+
+    for shard_index, (shard, reads, bases) in enumerate(shards, 1):
+        new_shard = blast.shard_path(args['blast_db'], shard_index)
+        for path in glob(shard + '.*'):
+            move(path, new_shard + path[len(shard):])
+        shard_built(cxn, new_shard, reads, bases)
+
+    db_preprocessor.update_metadata(cxn, 'shard_count', len(shards))
 
-        with open(fasta_path, 'w') as fasta_file:
-            for row in db_preprocessor.get_sequences_in_shard(
-                    cxn, limit, offset):
-                util.write_fasta_record(fasta_file, row[0], row[2], row[1])
+    log.info('Finished making all {} blast DBs'.format(len(shards)))
@@ -1,9 +1,12 @@
 """Handle common database functions."""
 
+import json
 import os
 import sqlite3
 import sys
-from os.path import basename, exists, join
+from os.path import basename, dirname, exists, join
+
+from . import bio
 
 ATRAM_VERSION = 'v2.4.4'
 
@@ -12,7 +15,16 @@ ATRAM_VERSION = 'v2.4.4'
 # Therefore DB_VERSION <= ATRAM_VERSION.
 DB_VERSION = '2.0'
 
-BATCH_SIZE = 1e6  # How many sequence records to insert at a time
+# The same DB layout but with the sequences stored as 2-bit packed BLOBs
+PACKED_DB_VERSION = DB_VERSION + '+2bit'
+
+BATCH_MEMORY = 256  # MB of sequence records to insert at a time
+BATCH_ROW_OVERHEAD = 200  # Bytes of python objects for each record in a batch
+
+SHARD_LABEL = 'shard:'  # Metadata label prefix for the shard manifest
+
+BULK_CACHE_SIZE = 2 ** 20  # KiB of page cache while bulk loading
+BULK_MMAP_SIZE = 2 ** 30  # Bytes of the DB to memory map while bulk loading
 
 
 def connect(blast_db, check_version=False, clean=False):
@@ -67,15 +79,61 @@ def db_setup(db_name):
     cxn = sqlite3.connect(db_name, timeout=30.0)
     cxn.execute('PRAGMA page_size = {}'.format(2 ** 16))
     cxn.execute("PRAGMA journal_mode = WAL")
+    add_functions(cxn)
     return cxn
 
 
+def bulk_load_setup(cxn):
+    """
+    Tune the connection for one writer loading a new database.
+
+    There is no journal and no syncing, so nothing else may use the database
+    until finish_bulk_load is called. A crash while loading may damage the
+    database.
+    """
+    cxn.execute('PRAGMA journal_mode = OFF')
+    cxn.execute('PRAGMA synchronous = OFF')
+    cxn.execute('PRAGMA cache_size = -{}'.format(BULK_CACHE_SIZE))
+    cxn.execute('PRAGMA locking_mode = EXCLUSIVE')
+    cxn.execute('PRAGMA mmap_size = {}'.format(BULK_MMAP_SIZE))
+
+
+def finish_bulk_load(cxn):
+    """
+    Make the database durable and ready for readers.
+
+    We have to release the exclusive lock before going back to WAL mode.
+    Then we gather statistics for the query planner and check the database.
+    """
+    cxn.execute('PRAGMA locking_mode = NORMAL')
+    cxn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+    cxn.execute('PRAGMA journal_mode = WAL')
+    cxn.execute('PRAGMA synchronous = FULL')
+    cxn.execute('ANALYZE')
+    check_integrity(cxn)
+
+
+def check_integrity(cxn):
+    """Make sure the database is not damaged."""
+    result = cxn.execute('PRAGMA quick_check').fetchone()[0]
+    if result != 'ok':
+        err = ('The database is damaged: {}. You need to rebuild it by '
+               'running atram_preprocessor.py again.').format(result)
+        sys.exit(err)
+
+
+def add_functions(cxn):
+    """Add the SQL functions that the queries use."""
+    cxn.create_function('unpack_seq', 1, bio.unpack_seq)
+    cxn.create_function('seq_length', 1, bio.seq_length)
+
+
 # ########################### misc functions #################################
 
 def check_versions(cxn):
     """Make sure the database version matches what we built it with."""
     version = get_version(cxn)
-    if version != DB_VERSION:
+    if version not in (DB_VERSION, PACKED_DB_VERSION):
         err = ('The database was built with version {} but you are running '
                'version {}. You need to rebuild the atram database by '
                'running atram_preprocessor.py again.').format(
@@ -101,6 +159,49 @@ def get_version(cxn):
     return get_metadata(cxn, 'version', default='1.0')
 
 
+def is_packed(cxn):
+    """Was the database built with 2-bit packed sequences."""
+    return get_version(cxn) == PACKED_DB_VERSION
+
+
+def has_read_ids(cxn):
+    """Was the database built with integer read IDs for the sequence names."""
+    result = get_metadata(cxn, 'read_ids', default='0')
+    return result != '0'
+
+
+def is_clustered(cxn):
+    """Was the sequences table clustered on the sequence name and end."""
+    result = get_metadata(cxn, 'clustered', default='0')
+    return result != '0'
+
+
+def is_deduped(cxn):
+    """Were duplicate reads collapsed when the database was built."""
+    result = get_metadata(cxn, 'dedup', default='0')
+    return result != '0'
+
+
+def get_shard_manifest(cxn, blast_db):
+    """
+    Get the blast DB shards the preprocessor recorded with their sizes.
+
+    The result maps each shard's path to its read count, base count and
+    checksum. It is empty for databases built before we recorded the shards.
+    """
+    sql = """SELECT label, value FROM metadata WHERE label LIKE ?"""
+    try:
+        rows = cxn.execute(sql, (SHARD_LABEL + '%',)).fetchall()
+    except sqlite3.OperationalError:
+        return {}
+
+    manifest = {}
+    for label, value in sorted(rows):
+        shard = join(dirname(blast_db), label[len(SHARD_LABEL):])
+        manifest[shard] = json.loads(value)
+    return manifest
+
+
 def is_single_end(cxn):
     """Was the database build for single ends."""
     result = get_metadata(cxn, 'single_ends', default='0')
@@ -115,5 +216,14 @@ def get_sequence_ends(cxn):
 
 
 def get_all_sequences(cxn):
-    """Get a list of all sequences in the database."""
-    return cxn.execute('SELECT * FROM sequences')
+    """Get a list of all sequences in the database with their names."""
+    if not has_read_ids(cxn):
+        return cxn.execute(
+            'SELECT seq_name, seq_end, unpack_seq(seq) FROM sequences')
+
+    sql = """
+        SELECT read_names.seq_name, seq_end, unpack_seq(seq)
+          FROM sequences
+          JOIN read_names ON (read_id = sequences.seq_name)
+        """
+    return cxn.execute(sql)
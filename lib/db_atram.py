@@ -2,6 +2,8 @@
 
 import sqlite3
 
+from . import db
+
 
 # ######################## sra_blast_hits table ###############################
 
@@ -12,7 +14,7 @@ def create_sra_blast_hits_table(cxn):
 
         CREATE TABLE aux.sra_blast_hits (
             iteration INTEGER,
-            seq_name  TEXT,
+            seq_name,  -- A name or an integer read ID like sequences
             seq_end   TEXT,
             shard     TEXT);
 
@@ -46,9 +48,9 @@ def sra_blast_hits_count(cxn, iteration):
 
 
 def get_sra_blast_hits(cxn, iteration):
-    """Get all blast hits for the iteration."""
+    """Get all blast hits for the iteration with their sequence names."""
     sql = """
-        SELECT seq_name, seq_end, seq
+        SELECT seq_name, seq_end, unpack_seq(seq) AS seq
           FROM sequences
          WHERE seq_name IN (SELECT DISTINCT seq_name
                               FROM aux.sra_blast_hits
@@ -56,6 +58,17 @@ def get_sra_blast_hits(cxn, iteration):
       ORDER BY seq_name, seq_end
         """
 
+    if db.has_read_ids(cxn):
+        sql = """
+            SELECT read_names.seq_name, seq_end, unpack_seq(seq) AS seq
+              FROM sequences
+              JOIN read_names ON (read_id = sequences.seq_name)
+             WHERE sequences.seq_name IN (SELECT DISTINCT seq_name
+                                            FROM aux.sra_blast_hits
+                                           WHERE iteration = ?)
+          ORDER BY sequences.seq_name, seq_end
+            """
+
     cxn.row_factory = sqlite3.Row
     return cxn.execute(sql, (iteration,))
 
@@ -63,7 +76,7 @@ def get_sra_blast_hits(cxn, iteration):
 def get_blast_hits_by_end_count(cxn, iteration, end_count):
     """Get all blast hits for the iteration."""
     sql = """
-        SELECT seq_name, seq_end, seq
+        SELECT seq_name, seq_end, unpack_seq(seq) AS seq
           FROM sequences
          WHERE seq_name IN (SELECT seq_name
                               FROM sequences
@@ -82,7 +95,7 @@ def get_blast_hits_by_end_count(cxn, iteration, end_count):
 def get_blast_hits(cxn, iteration):
     """Get all blast hits for the iteration."""
     sql = """
-        SELECT s.seq_name, s.seq_end, seq
+        SELECT s.seq_name, s.seq_end, unpack_seq(seq) AS seq
           FROM sequences AS s
           JOIN aux.sra_blast_hits AS h 
                ON (s.seq_name = h.seq_name AND s.seq_end = h.seq_end)
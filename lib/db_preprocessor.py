@@ -1,9 +1,20 @@
 """Database functions for the preprocessor."""
 
+import hashlib
+import json
 import os
-from os.path import join
+from itertools import islice
+from os.path import basename, join
 
-from .db import DB_VERSION
+from . import bio
+from .db import DB_VERSION, PACKED_DB_VERSION, SHARD_LABEL
+
+# How many sequences to unpack at once when reading them for the shards
+UNPACK_BATCH_SIZE = 10000
+
+# The built in length() is much faster for text sequences
+SEQ_LENGTH = """CASE WHEN typeof(seq) = 'blob' THEN seq_length(seq)
+                     ELSE length(seq) END"""
 
 
 def aux_db(cxn, temp_dir):
@@ -40,39 +51,186 @@ def create_metadata_table(cxn, args):
 
     with cxn:
         sql = """INSERT INTO metadata (label, value) VALUES (?, ?);"""
-        cxn.execute(sql, ('version', DB_VERSION))
+        version = PACKED_DB_VERSION if args.get('pack_seqs') else DB_VERSION
+        cxn.execute(sql, ('version', version))
         cxn.execute(sql, ('single_ends', bool(args.get('single_ends'))))
+        cxn.execute(sql, ('shard_count', args.get('shard_count')))
+        cxn.execute(sql, ('read_ids', bool(args.get('read_ids'))))
+        cxn.execute(sql, ('clustered', bool(args.get('cluster_seqs'))))
+        cxn.execute(sql, ('dedup', bool(args.get('dedup'))))
+
+
+def update_metadata(cxn, label, value):
+    """Replace a value in the metadata table."""
+    sql = """INSERT INTO metadata (label, value) VALUES (?, ?);"""
+    with cxn:
+        cxn.execute('DELETE FROM metadata WHERE label = ?', (label,))
+        cxn.execute(sql, (label, value))
+
+
+def add_shard_to_manifest(cxn, shard, reads, bases, checksum):
+    """
+    Record a finished blast DB shard and its size in the metadata table.
+
+    The shard is stored without its directory so the database can be moved.
+    The sizes are None for shards built before we recorded them.
+    """
+    value = json.dumps({
+        'reads': reads, 'bases': bases, 'checksum': checksum})
+    update_metadata(cxn, SHARD_LABEL + basename(shard), value)
+
+
+def delete_shard_manifest(cxn):
+    """Remove all of the shards from the metadata table."""
+    with cxn:
+        cxn.execute('DELETE FROM metadata WHERE label LIKE ?',
+                    (SHARD_LABEL + '%',))
+
+
+# ########################## checkpoints table ###############################
+
+def create_checkpoints_table(cxn):
+    """
+    Create the checkpoints table if it does not exist.
+
+    It records the finished steps so an interrupted run can be resumed. Loaded
+    files have the last row ID they loaded and blast shards have their file
+    name.
+    """
+    cxn.executescript("""
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            step  TEXT,
+            item  TEXT,
+            value INTEGER);
+        """)
+
+
+def add_checkpoint(cxn, step, item='', value=0):
+    """Record a finished step."""
+    sql = """INSERT INTO checkpoints (step, item, value) VALUES (?, ?, ?)"""
+    with cxn:
+        cxn.execute(sql, (step, item, value))
+
+
+def get_checkpoints(cxn, step):
+    """Get the finished items for the step."""
+    sql = """SELECT item, value FROM checkpoints WHERE step = ?"""
+    return dict(cxn.execute(sql, (step,)))
+
+
+def delete_checkpoints(cxn, step):
+    """Forget the finished items for the step."""
+    with cxn:
+        cxn.execute('DELETE FROM checkpoints WHERE step = ?', (step,))
 
 
 # ########################## sequences table ##################################
 
-def create_sequences_table(cxn):
-    """Create a table to hold the raw input sequences."""
+def create_sequences_table(cxn, read_ids=False):
+    """
+    Create a table to hold the raw input sequences.
+
+    With read IDs the seq_name column has no type affinity. It holds the
+    sequence names while loading and then the integer read IDs that replace
+    them. The names are kept in the read_names table. The number of bases is
+    recorded while loading so the shards can be balanced from the index.
+    """
     cxn.executescript("""
         DROP TABLE IF EXISTS sequences;
 
         CREATE TABLE sequences (
-            seq_name TEXT,
+            seq_name {},
             seq_end  TEXT,
-            seq      TEXT);
-        """)
+            seq      TEXT,  -- Or a 2-bit packed BLOB (see bio.pack_seq)
+            seq_len  INTEGER);
+        """.format('' if read_ids else 'TEXT'))
+
+
+def add_seq_len_column(cxn):
+    """
+    Add the sequence lengths to a database built before we recorded them.
+
+    This reads every sequence once. It is a no-op for newer databases.
+    """
+    columns = [c[1] for c in cxn.execute('PRAGMA table_info(sequences)')]
+    if 'seq_len' not in columns:
+        with cxn:
+            cxn.execute('ALTER TABLE sequences ADD COLUMN seq_len INTEGER')
+            cxn.execute('UPDATE sequences SET seq_len = {}'.format(
+                SEQ_LENGTH))
 
 
 def create_sequences_index(cxn):
     """
     Create the sequences index after we build the table.
 
-    This speeds up the program significantly.
+    This speeds up the program significantly. The lengths are in the index
+    so balancing the shards never has to read the sequences.
     """
     cxn.executescript("""
-        CREATE INDEX sequences_index ON sequences (seq_name, seq_end);
+        CREATE INDEX IF NOT EXISTS sequences_index
+            ON sequences (seq_name, seq_end, seq_len);
         """)
 
 
+def cluster_sequences_table(cxn, copies=False):
+    """
+    Rebuild the sequences table clustered on the sequence name and end.
+
+    The rows are sorted once (SQLite spills the sort into the temp directory)
+    and written in key order into a WITHOUT ROWID table. So mates sit on the
+    same page, a shard's name range is a sequential scan, and looking up a
+    sequence by name needs no separate index. The original row ID is kept as
+    a tie breaker for reads with duplicate names. The vacuum gives the space
+    of the old table back.
+    """
+    columns = ', copies' if copies else ''
+    copies = ',\n            copies   INTEGER' if copies else ''
+    cxn.executescript("""
+        DROP TABLE IF EXISTS clustered_sequences;
+
+        CREATE TABLE clustered_sequences (
+            seq_name,
+            seq_end  TEXT,
+            seq_id   INTEGER,  -- The row ID in the unclustered table
+            seq      TEXT,
+            seq_len  INTEGER{1},
+            PRIMARY KEY (seq_name, seq_end, seq_id)) WITHOUT ROWID;
+
+        BEGIN;
+
+        INSERT INTO clustered_sequences
+                    (seq_name, seq_end, seq_id, seq, seq_len{0})
+             SELECT seq_name, seq_end, rowid, seq, seq_len{0}
+               FROM sequences
+           ORDER BY seq_name, seq_end, rowid;
+
+        DROP TABLE sequences;
+
+        ALTER TABLE clustered_sequences RENAME TO sequences;
+
+        COMMIT;
+
+        VACUUM;
+        """.format(columns, copies))
+
+
+def sequences_table_is_clustered(cxn):
+    """Has the sequences table already been rebuilt as a clustered table."""
+    sql = """SELECT sql FROM sqlite_master
+              WHERE type = 'table' AND name = 'sequences'"""
+    result = cxn.execute(sql).fetchone()
+    return 'WITHOUT ROWID' in result[0].upper()
+
+
 def insert_sequences_batch(cxn, batch):
-    """Insert a batch of sequence records into the database."""
-    sql = """INSERT INTO sequences (seq_name, seq_end, seq)
-                VALUES (?, ?, ?);"""
+    """
+    Insert a batch of sequence records into the database.
+
+    The records are (seq_name, seq_end, seq, seq_len) rows.
+    """
+    sql = """INSERT INTO sequences (seq_name, seq_end, seq, seq_len)
+                VALUES (?, ?, ?, ?);"""
     if batch:
         with cxn:
             cxn.executemany(sql, batch)
@@ -84,12 +242,197 @@ def get_sequence_count(cxn):
     return result.fetchone()[0]
 
 
-def get_shard_cut(cxn, offset):
-    """Get the sequence name at the given offset."""
-    sql = 'SELECT seq_name FROM sequences ORDER BY seq_name LIMIT 1 OFFSET {}'
-    result = cxn.execute(sql.format(offset))
-    cut = result.fetchone()[0]
-    return cut
+def delete_sequences_after(cxn, last_rowid):
+    """Remove the sequences loaded after the given row ID."""
+    with cxn:
+        cxn.execute('DELETE FROM sequences WHERE rowid > ?', (last_rowid,))
+
+
+def get_max_rowid(cxn):
+    """Get the row ID of the last sequence loaded."""
+    result = cxn.execute('SELECT COALESCE(MAX(rowid), 0) FROM sequences')
+    return result.fetchone()[0]
+
+
+def get_shard_cuts(cxn, offsets):
+    """
+    Get the sequence names at all of the given offsets.
+
+    This does a single ordered pass over the sequences index instead of
+    walking the index from the start for every offset.
+    """
+    sql = """
+        SELECT pos, seq_name
+          FROM (SELECT seq_name,
+                       ROW_NUMBER() OVER (ORDER BY seq_name) - 1 AS pos
+                  FROM sequences)
+         WHERE pos IN ({})
+        """
+    in_list = ', '.join(str(int(offset)) for offset in set(offsets))
+    result = dict(cxn.execute(sql.format(in_list)))
+    return [result[int(offset)] for offset in offsets]
+
+
+# ########################## duplicate reads #################################
+
+class TemplateKey:
+    """
+    An SQL aggregate that hashes all of the ends of a template.
+
+    Two templates get the same key only when every end has the same sequence.
+    """
+
+    def __init__(self):
+        self.ends = []
+
+    def step(self, seq_end, seq):
+        """Add one end of the template."""
+        seq = seq if isinstance(seq, bytes) else seq.encode()
+        self.ends.append((seq_end or '', seq))
+
+    def finalize(self):
+        """Hash the ends in end order."""
+        key = hashlib.blake2b(digest_size=16)
+        for seq_end, seq in sorted(self.ends):
+            key.update(seq_end.encode())
+            key.update(len(seq).to_bytes(8, 'little'))
+            key.update(seq)
+        return key.digest()
+
+
+def add_copies_column(cxn):
+    """Add the column that counts how many copies of a read we collapsed."""
+    columns = [c[1] for c in cxn.execute('PRAGMA table_info(sequences)')]
+    if 'copies' not in columns:
+        cxn.execute(
+            'ALTER TABLE sequences ADD COLUMN copies INTEGER DEFAULT 1')
+
+
+def collapse_duplicates(cxn, last_rowid):
+    """
+    Keep one copy of each template loaded after last_rowid.
+
+    Templates are duplicates when all of their ends have identical sequences.
+    We keep the one with the lowest name and record the number of copies on
+    it. The grouping is done by SQLite, which sorts in the temp directory
+    when the data does not fit into memory, and the templates are compared
+    by a 16 byte hash. This must be called with the aux database attached.
+    It returns the number of templates removed.
+    """
+    cxn.create_aggregate('template_key', 2, TemplateKey)
+
+    cxn.execute("""
+        CREATE TABLE aux.template_keys AS
+             SELECT seq_name, template_key(seq_end, seq) AS key
+               FROM sequences
+              WHERE rowid > ?
+           GROUP BY seq_name
+        """, (last_rowid,))
+
+    cxn.executescript("""
+        CREATE TABLE aux.duplicates AS
+             SELECT key, MIN(seq_name) AS keep, COUNT(*) AS copies
+               FROM aux.template_keys
+           GROUP BY key
+             HAVING COUNT(*) > 1;
+        CREATE INDEX aux.duplicates_key ON duplicates (key);
+        CREATE INDEX aux.duplicates_keep ON duplicates (keep);
+
+        CREATE TABLE aux.removed AS
+             SELECT seq_name
+               FROM aux.template_keys
+               JOIN aux.duplicates USING (key)
+              WHERE seq_name <> keep;
+        CREATE INDEX aux.removed_name ON removed (seq_name);
+        """)
+
+    removed = cxn.execute('SELECT COUNT(*) FROM aux.removed').fetchone()[0]
+
+    with cxn:
+        cxn.execute("""
+            DELETE FROM sequences
+             WHERE rowid > ?
+               AND seq_name IN (SELECT seq_name FROM aux.removed)
+            """, (last_rowid,))
+        cxn.execute("""
+            UPDATE sequences
+               SET copies = (SELECT copies
+                               FROM aux.duplicates
+                              WHERE keep = sequences.seq_name)
+             WHERE rowid > ?
+               AND seq_name IN (SELECT keep FROM aux.duplicates)
+            """, (last_rowid,))
+
+    cxn.executescript("""
+        DROP TABLE aux.template_keys;
+        DROP TABLE aux.duplicates;
+        DROP TABLE aux.removed;
+        """)
+
+    return removed
+
+
+# ########################## sequence lengths ################################
+
+def get_length_range(cxn):
+    """
+    Get the shortest and longest sequence lengths and the total bases.
+
+    This only reads the sequences index.
+    """
+    sql = """SELECT MIN(seq_len), MAX(seq_len), SUM(seq_len) FROM sequences"""
+    return cxn.execute(sql).fetchone()
+
+
+def get_lengths_in_name_order(cxn):
+    """
+    Get every sequence name with its length ordered by the name.
+
+    This is a scan of the sequences index or of the clustered table.
+    """
+    sql = """SELECT seq_name, seq_len FROM sequences ORDER BY seq_name"""
+    return cxn.execute(sql)
+
+
+# ########################## read names ######################################
+
+def create_read_names_table(cxn):
+    """
+    Create the table that maps integer read IDs to sequence names.
+
+    Both ends of a template share a read ID.
+    """
+    cxn.executescript("""
+        CREATE TABLE IF NOT EXISTS read_names (
+            read_id  INTEGER PRIMARY KEY,
+            seq_name TEXT UNIQUE);
+        """)
+
+
+def assign_read_ids(cxn, last_rowid):
+    """
+    Replace the names of the sequences loaded after last_rowid with read IDs.
+
+    New names get the next read IDs in name order. So when we start with an
+    empty table, sorting by read ID is the same as sorting by name.
+    """
+    with cxn:
+        cxn.execute("""
+            INSERT OR IGNORE INTO read_names (seq_name)
+                 SELECT DISTINCT seq_name
+                   FROM sequences
+                  WHERE rowid > ?
+                    AND typeof(seq_name) = 'text'
+               ORDER BY seq_name
+            """, (last_rowid,))
+        cxn.execute("""
+            UPDATE sequences
+               SET seq_name = (SELECT read_id
+                                 FROM read_names
+                                WHERE read_names.seq_name = sequences.seq_name)
+             WHERE rowid > ?
+               AND typeof(seq_name) = 'text'
+            """, (last_rowid,))
 
 
 # ########################## sequence names ##################################
@@ -110,7 +453,7 @@ def get_sequences_in_shard(cxn, start, end):
          WHERE seq_name >= ?
            AND seq_name < ?
         """
-    return cxn.execute(sql, (start, end))
+    return unpack_rows(cxn.execute(sql, (start, end)))
 
 
 def get_shuffled_sequences_in_shard(cxn, shard_count, shard_index):
@@ -121,4 +464,39 @@ def get_shuffled_sequences_in_shard(cxn, shard_count, shard_index):
          WHERE seq_name IN (
                SELECT seq_name FROM aux.seq_names WHERE (rowid % ?) = ?);
         """
-    return cxn.execute(sql, (shard_count, shard_index))
+    return unpack_rows(cxn.execute(sql, (shard_count, shard_index)))
+
+
+def get_all_shard_sequences(cxn, ordered=False):
+    """Get every sequence for the blast DB shards, optionally in name order."""
+    sql = """SELECT seq_name, seq_end, seq FROM sequences"""
+    if ordered:
+        sql += ' ORDER BY seq_name'
+    return unpack_rows(cxn.execute(sql))
+
+
+def get_sequences_in_rowid_range(cxn, first, last):
+    """Get all sequences with row IDs after first and up to last."""
+    sql = """
+        SELECT seq_name, seq_end, seq
+          FROM sequences
+         WHERE rowid > ?
+           AND rowid <= ?
+        """
+    return unpack_rows(cxn.execute(sql, (first, last)))
+
+
+def unpack_rows(rows):
+    """
+    Unpack the sequences of the rows a batch at a time.
+
+    Unpacking many sequences at once is much faster than one at a time.
+    """
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, UNPACK_BATCH_SIZE))
+        if not batch:
+            return
+        seqs = bio.unpack_seqs([row[2] for row in batch])
+        for row, seq in zip(batch, seqs):
+            yield row[0], row[1], seq
@@ -41,22 +41,32 @@ class Logger:
         self.info('Python version: {}'.format(' '.join(sys.version.split())))
         self.info(' '.join(sys.argv[:]))
 
-    def subcommand(self, cmd, temp_dir, timeout=None):
+    def subcommand(self, cmd, temp_dir, timeout=None, feed=None):
         """
         Call a subprocess and log the output.
 
         Note: stdout=PIPE is blocking and large logs cause a hang.
         So we don't use it.
+
+        If there is a feed function we call it with the subprocess's stdin
+        so it can write the input, and then we close stdin.
         """
         self.debug(cmd)
 
         error = None
+        stdin = subprocess.PIPE if feed else None
 
         with tempfile.NamedTemporaryFile(mode='w', dir=temp_dir) as log_output:
             with subprocess.Popen(
-                    cmd, shell=True, stdout=log_output, stderr=log_output) as proc:
+                    cmd, shell=True, stdin=stdin, stdout=log_output,
+                    stderr=log_output, universal_newlines=True) as proc:
                 try:
-                    proc.communicate(timeout=timeout)
+                    if feed:
+                        feed(proc.stdin)
+                        proc.stdin.close()
+                        proc.wait(timeout=timeout)
+                    else:
+                        proc.communicate(timeout=timeout)
 
                 # Catch any error and kill all child processes
                 except Exception as err:  # pylint: disable=broad-except
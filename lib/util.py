@@ -3,18 +3,44 @@
 import bz2
 import gzip
 import io
+import lzma
 import os
 import re
 import signal
+import struct
+import subprocess
 import sys
+import zlib
 from contextlib import contextmanager
 from os.path import exists, getsize, join, split
-from shutil import rmtree
+from shutil import rmtree, which
 from tempfile import mkdtemp
 
 import psutil
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compression formats and the magic bytes at the start of their files
+MAGIC_BYTES = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bzip'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd')]
+
+SAMPLE_SIZE = 2 ** 20  # Compressed bytes to sample when estimating sizes
+DEFAULT_COMPRESSION_RATIO = 4  # When we cannot sample a compressed file
+
+# Programs that can decompress to a pipe, fastest first
+DECOMPRESSORS = {
+    'gzip': ['pigz', 'gzip'],
+    'bzip': ['pbzip2', 'lbzip2', 'bzip2'],
+    'xz': ['xz'],
+    'zstd': ['zstd']}
+
 
 def shorten(text):
     """Collapse whitespace in a string."""
@@ -22,9 +48,9 @@ def shorten(text):
 
 
 def write_fasta_record(out_file, seq_name, seq, seq_end=None):
-    """Write a fasta record to the file."""
+    """Write a fasta record to the file. The name may be a read ID."""
     out_file.write('>')
-    out_file.write(seq_name)
+    out_file.write(str(seq_name))
     if seq_end:
         out_file.write('/')
         out_file.write(seq_end)
@@ -62,11 +88,26 @@ def make_temp_dir(where=None, prefix=None, keep=False):
 
 @contextmanager
 def open_file(args, file_name):
-    """Handle creation and deletion of temporary directory."""
-    if args.get('gzip'):
-        stream = gzip.open(file_name, 'rt')
-    elif args.get('bzip'):
-        stream = bz2.open(file_name, 'rt')
+    """
+    Open a FASTA/Q file as a text stream and decompress it if needed.
+
+    The compression format is detected from the file's magic bytes. With the
+    --pipe-decompress option an external program decompresses the file in a
+    separate process so inflating and parsing run in parallel. This may run
+    in a worker process so errors are raised as an OSError instead of
+    exiting.
+    """
+    compression = compression_type(file_name)
+
+    proc = None
+    if compression and (args.get('pipe_decompress')
+                        or not has_codec(compression)):
+        proc = decompress_pipe(compression, file_name)
+
+    if proc:
+        stream = io.TextIOWrapper(proc.stdout)
+    elif compression:
+        stream = open_compressed(compression, file_name, 'rt')
     else:
         stream = open(file_name)
 
@@ -74,6 +115,129 @@ def open_file(args, file_name):
         yield stream
     finally:
         stream.close()
+        if proc and proc.wait() > 0:
+            raise OSError('Could not decompress "{}".'.format(file_name))
+
+
+def compression_type(file_name):
+    """Detect the file's compression format from its magic bytes."""
+    with open(file_name, 'rb') as raw:
+        head = raw.read(6)
+
+    for magic, compression in MAGIC_BYTES:
+        if head.startswith(magic):
+            return compression
+
+    return None
+
+
+def has_codec(compression):
+    """Can we decompress this format inside of python."""
+    return compression != 'zstd' or zstandard is not None
+
+
+def open_compressed(compression, file_name, mode):
+    """Open a compressed file with a python codec."""
+    if compression == 'gzip':
+        return gzip.open(file_name, mode)
+    if compression == 'bzip':
+        return bz2.open(file_name, mode)
+    if compression == 'xz':
+        return lzma.open(file_name, mode)
+    return zstandard.open(file_name, mode)
+
+
+def decompress_pipe(compression, file_name):
+    """Start an external program that decompresses the file to a pipe."""
+    for program in DECOMPRESSORS[compression]:
+        if which(program):
+            cmd = [program, '-dc', file_name]
+            return subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+    if not has_codec(compression):
+        err = ('We could not find a way to decompress "{}". Either install '
+               'the "zstandard" python module or the "zstd" '
+               'program.').format(file_name)
+        raise OSError(err)
+
+    return None
+
+
+@contextmanager
+def open_file_range(file_name, start, end, is_fastq):
+    """Open a byte range of an uncompressed FASTA/Q file as a text stream.
+
+    The range is widened or narrowed to the record boundaries at or after
+    the start and end offsets. So adjacent ranges cover every record exactly
+    once.
+    """
+    raw = open(file_name, 'rb')
+    first = record_boundary(raw, start, is_fastq)
+    last = record_boundary(raw, end, is_fastq)
+    raw.seek(first)
+    stream = io.TextIOWrapper(io.BufferedReader(RangeReader(raw, last)))
+
+    try:
+        yield stream
+    finally:
+        stream.close()
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Read a file from its current position up to the end offset.
+
+    So a byte range is read a buffer at a time instead of all at once.
+    """
+
+    def __init__(self, raw, end):
+        super().__init__()
+        self.raw = raw
+        self.left = end - raw.tell()
+
+    def readable(self):
+        """It is a readable stream."""
+        return True
+
+    def readinto(self, buffer):
+        """Fill the buffer with the next bytes of the range."""
+        size = min(len(buffer), self.left)
+        if size <= 0:
+            return 0
+        count = self.raw.readinto(memoryview(buffer)[:size])
+        self.left -= count
+        return count
+
+    def close(self):
+        """Close the file too."""
+        self.raw.close()
+        super().close()
+
+
+def record_boundary(raw, offset, is_fastq):
+    """Find the first FASTA/Q record that starts at or after the offset."""
+    if offset <= 0:
+        return 0
+
+    # Skip the rest of the line unless we're already at the start of one
+    raw.seek(offset - 1)
+    if raw.read(1) != b'\n':
+        raw.readline()
+
+    while True:
+        pos = raw.tell()
+        line = raw.readline()
+        if not line:
+            return pos
+        if not is_fastq and line.startswith(b'>'):
+            return pos
+        if is_fastq and line.startswith(b'@'):
+            # A quality line may start with an "@" too. A header is always
+            # two lines before the "+" separator.
+            raw.readline()
+            if raw.readline().startswith(b'+'):
+                return pos
+            raw.seek(pos + len(line))
 
 
 def clean_name(name):
@@ -115,20 +279,18 @@ def is_fastq_file(args, file_name):
         return True
 
     parts = file_name.lower().split('.')
-    index = -2 if re.search(r'[zp2]$', parts[-1]) and len(parts) > 2 else -1
+    compressed = re.search(r'[zp2]$|^zst$', parts[-1])
+    index = -2 if compressed and len(parts) > 2 else -1
     return parts[index].startswith('f') and parts[index].endswith('q')
 
 
 def shard_file_size(args, file_name):
-    """Calculate shard file size for FASTA/Q files in raw or zipped format."""
+    """Estimate shard file size for FASTA/Q files in raw or zipped format."""
     file_size = getsize(file_name)
 
-    if args.get('gzip'):
-        with gzip.open(file_name, 'rb') as zippy:
-            file_size = zippy.seek(0, io.SEEK_END)
-    elif args.get('bzip'):
-        with bz2.open(file_name, 'rb') as zippy:
-            file_size = zippy.seek(0, io.SEEK_END)
+    compression = compression_type(file_name)
+    if compression:
+        file_size = estimate_uncompressed_size(compression, file_name)
 
     if is_fastq_file(args, file_name):
         file_size /= 2  # Guessing that fastq files ~2x fasta files
@@ -136,6 +298,70 @@ def shard_file_size(args, file_name):
     return file_size
 
 
+def estimate_uncompressed_size(compression, file_name):
+    """
+    Estimate the uncompressed size of a file without decompressing it all.
+
+    We decompress a sample from the start of the file and extrapolate using
+    its compression ratio. A gzip trailer has the exact size but only modulo
+    4 GiB and only for the last member, so we use it only when it agrees with
+    the sampled estimate.
+    """
+    file_size = getsize(file_name)
+
+    with open(file_name, 'rb') as raw:
+        sample = raw.read(SAMPLE_SIZE)
+        trailer_size = 0
+        if compression == 'gzip' and file_size > len(sample):
+            raw.seek(-4, io.SEEK_END)
+            trailer_size = struct.unpack('<I', raw.read(4))[0]
+
+    if not sample:
+        return 0
+
+    inflated = sample_inflated_size(compression, sample)
+    if not inflated:
+        return file_size * DEFAULT_COMPRESSION_RATIO
+
+    estimate = file_size * inflated / len(sample)
+
+    if estimate * 0.8 <= trailer_size <= estimate * 1.25:
+        return trailer_size
+
+    return estimate
+
+
+def sample_inflated_size(compression, sample):
+    """Decompress a sample of a compressed file and return its length."""
+    inflated = 0
+
+    # Some files (like bgzip files) are many compressed members in a row
+    while sample:
+        decompressor = get_decompressor(compression)
+        if not decompressor:
+            break
+        try:
+            inflated += len(decompressor.decompress(sample))
+        except (EOFError, OSError, ValueError, lzma.LZMAError, zlib.error):
+            break
+        sample = getattr(decompressor, 'unused_data', b'')
+
+    return inflated
+
+
+def get_decompressor(compression):
+    """Get an incremental decompressor for the compression format."""
+    if compression == 'gzip':
+        return zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    if compression == 'bzip':
+        return bz2.BZ2Decompressor()
+    if compression == 'xz':
+        return lzma.LZMADecompressor()
+    if zstandard:
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
 def prefix_file(prefix, name):
     """Calculate the output path."""
     dir_, file_ = split(prefix)
@@ -27,3 +27,41 @@ def test_is_protein_yes():
     """Any protein character makes the whole sequence a protein."""
     seq = 'ACGTUWSMKRYBeDHVNXacgtuwsmkrybdhvnx'
     assert bio.is_protein(seq)
+
+
+def test_pack_seq_01():
+    """Packing and unpacking returns the original sequence."""
+    seq = 'ACGTNNNNacgtRYACG'
+    assert bio.unpack_seq(bio.pack_seq(seq)) == seq
+
+
+def test_pack_seq_02():
+    """It packs 4 bases into a byte."""
+    seq = 'ACGT' * 10
+    assert len(bio.pack_seq(seq)) == bio.PACKED_HEADER.size + 10
+
+
+def test_unpack_seq_01():
+    """It returns unpacked text as is."""
+    assert bio.unpack_seq('ACGT') == 'ACGT'
+
+
+def test_seq_length_01():
+    """It counts the bases of text and packed sequences."""
+    assert bio.seq_length('ACGTN') == 5
+    assert bio.seq_length(bio.pack_seq('ACGTNNACGTA')) == 11
+
+
+def test_pack_seqs_01():
+    """It packs a batch the same as packing each sequence alone."""
+    seqs = ['ACGN', 'NNAC', '', 'ACGTA', 'RRYN']
+    packed = bio.pack_seqs(seqs)
+    assert packed[1] == bio.pack_seq('NNAC')
+    assert [bio.PACKED_HEADER.unpack_from(p) for p in packed] == [
+        (4, 1), (4, 1), (0, 0), (5, 0), (4, 3)]
+    assert bio.unpack_seqs(packed) == seqs
+
+
+def test_unpack_seqs_01():
+    """It returns text as is and unpacks the rest of the batch."""
+    assert bio.unpack_seqs(['ACGT', bio.pack_seq('NACG')]) == ['ACGT', 'NACG']
@@ -100,3 +100,25 @@ def test_parse_fasta_title_12():
         'title 2 words', 'single_ends', '')
     assert seq_name == 'title 2'
     assert seq_end == ''
+
+
+def test_tabular_hits_01(tmp_path):
+    """It skips repeated HSP lines to get one hit per sequence."""
+    path = tmp_path / 'hits.tsv'
+    path.write_text('q1\tseq1/1\nq1\tseq1/1\nq1\tseq2 2\nq2\tseq1/1\n')
+    assert list(blast.tabular_hits(str(path))) == [
+        ('q1', 'seq1/1'), ('q1', 'seq2 2'), ('q2', 'seq1/1')]
+
+
+def test_first_query_id_01(tmp_path):
+    """It gets the ID of the first query sequence like blast does."""
+    path = tmp_path / 'query.fasta'
+    path.write_text('\n>query1 some title\nACGT\n>query2\nACGT\n')
+    assert blast.first_query_id(str(path)) == 'query1'
+
+
+def test_first_query_id_02(tmp_path):
+    """It returns an empty ID for a file without sequences."""
+    path = tmp_path / 'query.fasta'
+    path.write_text('')
+    assert blast.first_query_id(str(path)) == ''
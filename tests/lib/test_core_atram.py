@@ -0,0 +1,129 @@
+"""Testing functions in lib/core_atram."""
+
+import os
+import sys
+
+import lib.blast as blast
+import lib.core_atram as core_atram
+from lib.log import Logger
+
+
+def shard_manifest(sizes):
+    """Build a shard manifest with the given base counts."""
+    return {'dir/db.{:03d}.blast'.format(i): {
+        'reads': None if bases is None else bases // 100,
+        'bases': bases,
+        'checksum': i} for i, bases in enumerate(sizes, 1)}
+
+
+def test_group_shards_01():
+    """It gives each CPU a group of shards with about the same bases."""
+    manifest = shard_manifest([400, 100, 300, 200, 100, 100])
+    groups, db_size = core_atram.group_shards(manifest, list(manifest), 2)
+    assert groups == [
+        ['dir/db.001.blast', 'dir/db.002.blast', 'dir/db.005.blast'],
+        ['dir/db.003.blast', 'dir/db.004.blast', 'dir/db.006.blast']]
+    assert db_size == 200
+
+
+def test_group_shards_02():
+    """It uses one shard per run when a shard's size is unknown."""
+    manifest = shard_manifest([100, None, 100])
+    groups, db_size = core_atram.group_shards(manifest, list(manifest), 2)
+    assert groups == [[s] for s in manifest]
+    assert db_size is None
+
+
+def test_blast_hit_rows_01():
+    """It splits the read ends and converts read IDs."""
+    titles = ['12/1', '34 2']
+    rows = core_atram.blast_hit_rows(titles, 3, 'db.001.blast', False, True)
+    assert list(rows) == [
+        (3, '1', 12, 'db.001.blast'), (3, '2', 34, 'db.001.blast')]
+
+
+def test_budget_01():
+    """It caps a request at the whole budget and gives it back."""
+    budget = core_atram.Budget(4, 16)
+    assert budget.reserve(8, 4) == (4, 4)
+    assert budget.free == {'cpus': 0, 'memory': 12}
+    budget.release(4, 4)
+    assert budget.free == budget.total
+
+
+class FinishInReverse:
+    """A pool whose searches finish in the reverse order they start."""
+
+    def __init__(self, results):
+        self.results = results
+        self.callbacks = []
+
+    def apply_async(self, func, args, callback, error_callback):
+        """Hold the callbacks until every search has started."""
+        result = self.results[args[1][0]]
+        finish = error_callback if isinstance(result, Exception) else callback
+        self.callbacks.insert(0, (finish, result))
+        if len(self.callbacks) == len(self.results):
+            for finish, result in self.callbacks:
+                finish(result)
+
+
+def test_completed_searches_01():
+    """It yields the hit rows in the order the searches finish."""
+    pool = FinishInReverse({'a': [1], 'b': [2], 'c': [3]})
+    hits = core_atram.completed_searches(pool, {}, [['a'], ['b'], ['c']], None)
+    assert list(hits) == [[3], [2], [1]]
+
+
+def test_completed_searches_02(tmp_path):
+    """It raises the error of a failed search after the others finish."""
+    spool_path = tmp_path / 'a.spool'
+    spool_path.write_bytes(b'')
+    pool = FinishInReverse({
+        'a': str(spool_path), 'b': RuntimeError('blast'), 'c': OSError()})
+    hits = core_atram.completed_searches(
+        pool, {}, [['a'], ['b'], ['c']], None)
+    try:
+        list(hits)
+        assert False
+    except OSError:
+        assert not spool_path.exists()
+
+
+def test_blast_query_against_one_shard_01(tmp_path, monkeypatch):
+    """A fatal error in the worker comes back as an error, not an exit."""
+    def bad_json(args, log, state, output_file, *_):
+        with open(output_file, 'w') as out_file:
+            out_file.write('not json')
+
+    monkeypatch.setattr(blast, 'against_sra', bad_json)
+    monkeypatch.setattr(core_atram, 'WORKER', {
+        'args': {}, 'log': Logger(None, 'fatal')})
+    state = {'iter_dir': str(tmp_path), 'iteration': 1, 'query_file': 'q',
+             'is_single_end': False, 'read_ids': False}
+    try:
+        core_atram.blast_query_against_one_shard(state, ['dir/db.001.blast'])
+        assert False
+    except RuntimeError as err:
+        assert str(err) == 'The blast search of shard "db.001.blast" failed'
+
+
+def test_spooled_hit_rows_01(tmp_path, monkeypatch):
+    """It reads back every spooled row and removes the spool file."""
+    monkeypatch.setattr(core_atram, 'HIT_BATCH_SIZE', 2)
+    rows = [(1, '1', 'seq{}'.format(i), 'db.001.blast') for i in range(5)]
+    spool_path = core_atram.spool_hit_rows(iter(rows), str(tmp_path))
+    assert list(core_atram.spooled_hit_rows(spool_path)) == rows
+    assert not os.path.exists(spool_path)
+
+
+def test_assemble_job_in_thread_01(monkeypatch, capsys):
+    """It logs why a job exited without stopping the other jobs."""
+    def fail(*_):
+        sys.exit('The database is damaged')
+
+    monkeypatch.setattr(core_atram, 'assemble_job', fail)
+    args = {'log_file': None, 'log_level': 'info'}
+    core_atram.assemble_job_in_thread(args, None, ('db', ['q'], {}))
+    assert 'The job for blast DB "db" stopped: The database is damaged' \
+        in capsys.readouterr().out
@@ -0,0 +1,192 @@
+"""Testing functions in lib/core_preprocessor."""
+
+import sqlite3
+
+import lib.bio as bio
+import lib.core_preprocessor as core_preprocessor
+import lib.db as db
+import lib.db_preprocessor as db_preprocessor
+from lib.log import Logger
+
+LOG = Logger(None, 'fatal')
+
+
+def test_byte_batches_01():
+    """It splits the rows when a batch reaches the byte limit."""
+    rows = [('seq{}'.format(i), '1', 'A' * 96) for i in range(5)]
+    max_bytes = 2 * (100 + db.BATCH_ROW_OVERHEAD)
+    sizes = [len(b) for b in core_preprocessor.byte_batches(rows, max_bytes)]
+    assert sizes == [2, 2, 1]
+
+
+def test_byte_batches_02():
+    """It reuses the same list for every batch."""
+    rows = [('seq{}'.format(i), '1', 'A' * 96) for i in range(5)]
+    batches = core_preprocessor.byte_batches(rows, 1)
+    assert next(batches) is next(batches)
+
+
+def test_hash_shard_01():
+    """It puts read IDs and names in the same shard every run."""
+    assert core_preprocessor.hash_shard('seq1', 7) == 1
+    assert core_preprocessor.hash_shard(42, 7) == \
+        core_preprocessor.hash_shard('42', 7)
+
+
+def test_base_balanced_cuts_01():
+    """It splits the shards by bases and keeps both ends together."""
+    rows = [('a', 100), ('a', 100), ('b', 10), ('c', 10), ('d', 50),
+            ('d', 50), ('e', 80)]
+    cuts, shard_bases = core_preprocessor.base_balanced_cuts(rows, 400, 2)
+    assert cuts == ['a', 'b', 'e']
+    assert shard_bases == [200, 200]
+
+
+def test_worker_pool_01():
+    """It uses the shared pool of a batch and leaves it open."""
+    shared = object()
+    core_preprocessor.SHARED_POOL = shared
+    try:
+        with core_preprocessor.worker_pool({'cpus': 2}) as pool:
+            assert pool is shared
+        core_preprocessor.close_pool(pool)
+    finally:
+        core_preprocessor.SHARED_POOL = None
+
+
+def test_assign_new_seqs_to_shards_01():
+    """It splits only the appended row IDs into shards."""
+    cxn = sqlite3.connect(':memory:')
+    db_preprocessor.create_sequences_table(cxn)
+    db_preprocessor.insert_sequences_batch(
+        cxn, [('seq{}'.format(i), '1', 'ACGT', 4) for i in range(10)])
+    shards = core_preprocessor.assign_new_seqs_to_shards(cxn, LOG, 4, 2)
+    assert shards == [(4, 7), (7, 10)]
+
+
+def test_assign_new_seqs_to_shards_02():
+    """It does not make more shards than there are new sequences."""
+    cxn = sqlite3.connect(':memory:')
+    db_preprocessor.create_sequences_table(cxn)
+    db_preprocessor.insert_sequences_batch(
+        cxn, [('seq{}'.format(i), '1', 'ACGT', 4) for i in range(5)])
+    shards = core_preprocessor.assign_new_seqs_to_shards(cxn, LOG, 3, 4)
+    assert shards == [(3, 4), (4, 5)]
+
+
+def test_append_seqs_01(tmp_path, monkeypatch):
+    """It loads the new sequences and builds shards only for them."""
+    blast_db = str(tmp_path / 'db')
+    args = {'blast_db': blast_db, 'temp_dir': str(tmp_path),
+            'end_1': [str(tmp_path / 'new.fasta')], 'shard_count': 2}
+    with db.connect(blast_db) as cxn:
+        db_preprocessor.create_metadata_table(cxn, {'shard_count': 1})
+        db_preprocessor.create_sequences_table(cxn)
+        db_preprocessor.insert_sequences_batch(
+            cxn, [('old1', '1', 'ACGT', 4)])
+    for ext in ('nhr', 'nin', 'nsq'):
+        (tmp_path / 'db.001.blast.{}'.format(ext)).write_bytes(b'shard')
+    (tmp_path / 'new.fasta').write_text('>new1\nAAAA\n>new2\nCCCC\n')
+
+    built = []
+    monkeypatch.setattr(
+        core_preprocessor, 'build_blast_shards',
+        lambda *a, **kw: built.append((a[3], a[4], kw['first_shard'])))
+    core_preprocessor.append_seqs(args, LOG)
+
+    getter, shard_list, first_shard = built[0]
+    assert getter == db_preprocessor.get_sequences_in_rowid_range
+    assert shard_list == [(1, 2), (2, 3)]
+    assert first_shard == 2
+    with db.connect(blast_db) as cxn:
+        rows = cxn.execute('SELECT seq_name, seq_end, seq FROM sequences')
+        assert list(rows) == [('old1', '1', 'ACGT'),
+                              ('new1', '1', 'AAAA'),
+                              ('new2', '1', 'CCCC')]
+        assert db.get_metadata(cxn, 'shard_count') == '3'
+        assert list(db.get_shard_manifest(cxn, blast_db)) == [
+            blast_db + '.001.blast']
+
+
+def test_load_seqs_01(tmp_path):
+    """When resuming it removes a partly loaded file's rows and reloads it."""
+    loaded = str(tmp_path / 'loaded.fasta')
+    partial = str(tmp_path / 'partial.fasta')
+    (tmp_path / 'loaded.fasta').write_text('>seq1\nAAAA\n')
+    (tmp_path / 'partial.fasta').write_text('>seq2\nCCCC\n>seq3\nGGGG\n')
+
+    cxn = sqlite3.connect(':memory:')
+    db_preprocessor.create_sequences_table(cxn)
+    db_preprocessor.create_checkpoints_table(cxn)
+    db_preprocessor.insert_sequences_batch(
+        cxn, [('seq1', '1', 'AAAA', 4), ('seq2', '1', 'CCCC', 4)])
+    db_preprocessor.add_checkpoint(cxn, 'loaded', loaded, 1)
+
+    args = {'resume': True, 'end_1': [loaded, partial]}
+    core_preprocessor.load_seqs(args, cxn, LOG)
+
+    rows = cxn.execute('SELECT seq_name FROM sequences ORDER BY rowid')
+    assert list(rows) == [('seq1',), ('seq2',), ('seq3',)]
+    assert db_preprocessor.get_checkpoints(cxn, 'loaded') == {
+        loaded: 1, partial: 3}
+
+
+def test_index_seqs_01():
+    """When resuming it does not cluster a table that is already clustered."""
+    cxn = sqlite3.connect(':memory:')
+    db_preprocessor.create_sequences_table(cxn)
+    db_preprocessor.create_checkpoints_table(cxn)
+    db_preprocessor.insert_sequences_batch(
+        cxn, [('seq2', '1', 'AAAA', 4), ('seq1', '1', 'CCCC', 4)])
+    args = {'resume': True, 'cluster_seqs': True}
+
+    core_preprocessor.index_seqs(args, cxn, LOG)
+    db_preprocessor.delete_checkpoints(cxn, 'indexed')
+    core_preprocessor.index_seqs(args, cxn, LOG)
+
+    rows = cxn.execute('SELECT seq_name, seq FROM sequences')
+    assert list(rows) == [('seq1', 'CCCC'), ('seq2', 'AAAA')]
+    assert core_preprocessor.finished(args, cxn, 'indexed')
+
+
+def test_unfinished_shards_01(tmp_path):
+    """It skips the finished shards even when the DB path changes."""
+    cxn = sqlite3.connect(':memory:')
+    db_preprocessor.create_checkpoints_table(cxn)
+    for shard_index in (1, 3):
+        db_preprocessor.add_checkpoint(
+            cxn, 'shard', 'old/dir/db.{:03d}.blast'.format(shard_index))
+    for shard_index in (1, 2):
+        for ext in ('nhr', 'nin', 'nsq'):
+            path = tmp_path / 'db.{:03d}.blast.{}'.format(shard_index, ext)
+            path.write_bytes(b'shard')
+
+    args = {'resume': True, 'blast_db': str(tmp_path / '.' / 'db')}
+    shards = core_preprocessor.unfinished_shards(
+        args, cxn, ['a', 'b', 'c'], 1)
+    assert shards == [(2, 'b'), (3, 'c')]
+
+
+def test_insert_batch_01(tmp_path):
+    """It inserts the rows and writes them unpacked to their hash shards."""
+    cxn = sqlite3.connect(':memory:')
+    db_preprocessor.create_sequences_table(cxn)
+    shard_files = core_preprocessor.open_shard_fastas(
+        {'temp_dir': str(tmp_path)}, 3)
+    batch = [('seq1', '1', bio.pack_seq('ACGTN'), 5),
+             ('seq2', '1', bio.pack_seq('CCCC'), 4),
+             ('seq1', '2', bio.pack_seq('GGGG'), 4)]
+
+    core_preprocessor.insert_batch(cxn, batch, shard_files)
+    for fasta in shard_files:
+        fasta.close()
+
+    assert db_preprocessor.get_sequence_count(cxn) == 3
+    slot1 = core_preprocessor.hash_shard('seq1', 3)
+    slot2 = core_preprocessor.hash_shard('seq2', 3)
+    assert slot1 != slot2
+    with open(shard_files[slot1].path) as fasta:
+        assert fasta.read() == '>seq1/1\nACGTN\n>seq1/2\nGGGG\n'
+    with open(shard_files[slot2].path) as fasta:
+        assert fasta.read() == '>seq2/1\nCCCC\n'
+    assert (shard_files[slot1].reads, shard_files[slot1].bases) == (2, 9)
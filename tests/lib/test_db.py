@@ -1,6 +1,7 @@
 """Testing functions in lib/db."""
 
 import sqlite3
+import lib.bio as bio
 import lib.db as db
 import lib.db_atram as db_atram
 import lib.db_preprocessor as db_preprocessor
@@ -33,3 +34,131 @@ def test_get_version_02():
     """It returns a default version if there is no metadata table."""
     CXN.execute("""DROP TABLE IF EXISTS metadata""")
     assert db.get_version(CXN) == '1.0'
+
+
+def test_get_shard_cuts_01():
+    """It gets the sequence names at every offset in one query."""
+    cxn = sqlite3.connect(':memory:')
+    db_preprocessor.create_sequences_table(cxn)
+    db_preprocessor.insert_sequences_batch(
+        cxn,
+        [('seq{}'.format(i), '1', 'ACGT', 4) for i in range(9, -1, -1)])
+    db_preprocessor.create_sequences_index(cxn)
+    cuts = db_preprocessor.get_shard_cuts(cxn, [0, 4, 4, 9])
+    assert cuts == ['seq0', 'seq4', 'seq4', 'seq9']
+
+
+def test_cluster_sequences_table_01():
+    """It keeps every row, including duplicate names, in name order."""
+    cxn = sqlite3.connect(':memory:')
+    db_preprocessor.create_sequences_table(cxn)
+    db_preprocessor.insert_sequences_batch(cxn, [
+        ('seq2', '1', 'AAAA', 4), ('seq1', '2', 'CCCC', 4),
+        ('seq1', '1', 'GGGG', 4), ('seq1', '1', 'TTTT', 4)])
+    db_preprocessor.cluster_sequences_table(cxn)
+    rows = cxn.execute('SELECT seq_name, seq_end, seq FROM sequences')
+    assert list(rows) == [
+        ('seq1', '1', 'GGGG'), ('seq1', '1', 'TTTT'),
+        ('seq1', '2', 'CCCC'), ('seq2', '1', 'AAAA')]
+
+
+def test_cluster_sequences_table_02():
+    """It keeps text affinity for the sequences with and without copies."""
+    for copies in (False, True):
+        cxn = sqlite3.connect(':memory:')
+        db_preprocessor.create_sequences_table(cxn)
+        if copies:
+            db_preprocessor.add_copies_column(cxn)
+        db_preprocessor.insert_sequences_batch(
+            cxn, [('seq1', '1', 'ACGT', 4)])
+        db_preprocessor.cluster_sequences_table(cxn, copies)
+        cxn.execute("""INSERT INTO sequences (seq_name, seq_end, seq_id, seq)
+                         VALUES ('seq2', '1', 2, '0012')""")
+        rows = cxn.execute('SELECT typeof(seq), seq FROM sequences')
+        assert list(rows) == [('text', 'ACGT'), ('text', '0012')]
+
+
+def test_collapse_duplicates_01():
+    """It keeps one copy of templates where every end is identical."""
+    cxn = sqlite3.connect(':memory:')
+    cxn.execute("""ATTACH DATABASE ':memory:' AS aux""")
+    db_preprocessor.create_sequences_table(cxn)
+    db_preprocessor.insert_sequences_batch(cxn, [
+        ('seq1', '1', 'AAAA', 4), ('seq1', '2', 'CCCC', 4),
+        ('seq2', '1', 'AAAA', 4), ('seq2', '2', 'CCCC', 4),
+        ('seq3', '1', 'AAAA', 4), ('seq3', '2', 'GGGG', 4),
+        ('seq4', '1', 'AAAA', 4)])
+    db_preprocessor.add_copies_column(cxn)
+    assert db_preprocessor.collapse_duplicates(cxn, 0) == 1
+    rows = cxn.execute("""
+        SELECT seq_name, seq_end, copies FROM sequences ORDER BY rowid""")
+    assert list(rows) == [
+        ('seq1', '1', 2), ('seq1', '2', 2),
+        ('seq3', '1', 1), ('seq3', '2', 1),
+        ('seq4', '1', 1)]
+
+
+def read_ids_db(rows):
+    """Build a sequences table with read IDs from the rows."""
+    cxn = sqlite3.connect(':memory:')
+    db_preprocessor.create_sequences_table(cxn, read_ids=True)
+    db_preprocessor.create_read_names_table(cxn)
+    db_preprocessor.insert_sequences_batch(cxn, rows)
+    return cxn
+
+
+def test_assign_read_ids_01():
+    """It gives both ends the same ID in name order and can run again."""
+    cxn = read_ids_db([
+        ('seqB', '1', 'AAAA', 4), ('seqA', '1', 'CCCC', 4),
+        ('seqB', '2', 'GGGG', 4)])
+    db_preprocessor.assign_read_ids(cxn, 0)
+    db_preprocessor.assign_read_ids(cxn, 0)
+    rows = cxn.execute(
+        'SELECT seq_name, seq_end FROM sequences ORDER BY rowid')
+    assert list(rows) == [(2, '1'), (1, '1'), (2, '2')]
+    names = cxn.execute('SELECT read_id, seq_name FROM read_names')
+    assert list(names) == [(1, 'seqA'), (2, 'seqB')]
+
+
+def test_assign_read_ids_02():
+    """Appended sequences reuse the ID of a known name or get a new one."""
+    cxn = read_ids_db([('seqB', '1', 'AAAA', 4), ('seqC', '1', 'CCCC', 4)])
+    db_preprocessor.assign_read_ids(cxn, 0)
+    db_preprocessor.insert_sequences_batch(
+        cxn, [('seqA', '1', 'GGGG', 4), ('seqB', '2', 'TTTT', 4)])
+    db_preprocessor.assign_read_ids(cxn, 2)
+    rows = cxn.execute(
+        'SELECT seq_name, seq_end FROM sequences ORDER BY rowid')
+    assert list(rows) == [(1, '1'), (2, '1'), (3, '1'), (1, '2')]
+    names = cxn.execute('SELECT read_id, seq_name FROM read_names')
+    assert list(names) == [(1, 'seqB'), (2, 'seqC'), (3, 'seqA')]
+
+
+def test_get_length_range_01():
+    """It gets the lengths recorded while loading from the index."""
+    cxn = sqlite3.connect(':memory:')
+    db_preprocessor.create_sequences_table(cxn)
+    db_preprocessor.insert_sequences_batch(cxn, [
+        ('seq2', '1', 'AAAAAA', 6), ('seq1', '1', 'CC', 2),
+        ('seq1', '2', 'GGGG', 4)])
+    db_preprocessor.create_sequences_index(cxn)
+    assert db_preprocessor.get_length_range(cxn) == (2, 6, 12)
+    rows = db_preprocessor.get_lengths_in_name_order(cxn)
+    assert sorted(rows) == [('seq1', 2), ('seq1', 4), ('seq2', 6)]
+    plan = cxn.execute(
+        'EXPLAIN QUERY PLAN SELECT SUM(seq_len) FROM sequences')
+    assert 'COVERING INDEX' in plan.fetchone()[3]
+
+
+def test_add_seq_len_column_01():
+    """It records the lengths of text and packed sequences in old DBs."""
+    cxn = sqlite3.connect(':memory:')
+    db.add_functions(cxn)
+    cxn.execute('CREATE TABLE sequences (seq_name, seq_end, seq)')
+    cxn.executemany('INSERT INTO sequences VALUES (?, ?, ?)', [
+        ('seq1', '1', 'ACG'), ('seq2', '1', bio.pack_seq('ACGTNA'))])
+    db_preprocessor.add_seq_len_column(cxn)
+    db_preprocessor.add_seq_len_column(cxn)
+    rows = cxn.execute('SELECT seq_name, seq_len FROM sequences')
+    assert list(rows) == [('seq1', 3), ('seq2', 6)]
@@ -0,0 +1,72 @@
+"""Testing functions in lib/util."""
+
+import gzip
+import io
+
+import lib.util as util
+
+
+def test_record_boundary_01():
+    """It returns the start of the file for offset zero."""
+    raw = io.BytesIO(b'>seq1\nACGT\n>seq2\nACGT\n')
+    assert util.record_boundary(raw, 0, False) == 0
+
+
+def test_record_boundary_02():
+    """It skips to the next FASTA header."""
+    raw = io.BytesIO(b'>seq1\nACGT\n>seq2\nACGT\n')
+    assert util.record_boundary(raw, 3, False) == 11
+
+
+def test_record_boundary_03():
+    """It returns the end of the file when there are no more records."""
+    raw = io.BytesIO(b'>seq1\nACGT\n>seq2\nACGT\n')
+    assert util.record_boundary(raw, 12, False) == 22
+
+
+def test_record_boundary_04():
+    """It does not mistake a FASTQ quality line for a header."""
+    raw = io.BytesIO(b'@seq1\nACGT\n+\n@III\n@seq2\nACGT\n+\nIIII\n')
+    assert util.record_boundary(raw, 12, True) == 18
+
+
+def test_compression_type_01(tmp_path):
+    """It detects gzip files from their magic bytes."""
+    path = tmp_path / 'reads.fastq'
+    path.write_bytes(b'\x1f\x8b\x08\x00')
+    assert util.compression_type(str(path)) == 'gzip'
+
+
+def test_compression_type_02(tmp_path):
+    """It returns None for uncompressed files."""
+    path = tmp_path / 'reads.fastq.gz'
+    path.write_bytes(b'@seq1\nACGT\n+\nIIII\n')
+    assert util.compression_type(str(path)) is None
+
+
+def test_open_file_01(tmp_path):
+    """It raises an error that a worker can pass back for a bad file."""
+    path = tmp_path / 'reads.fastq.gz'
+    path.write_bytes(gzip.compress(b'@seq1\nACGT\n+\nIIII\n' * 1000)[:100])
+    try:
+        with util.open_file({'pipe_decompress': True}, str(path)) as stream:
+            stream.read()
+        assert False
+    except OSError as err:
+        assert str(err) == 'Could not decompress "{}".'.format(path)
+
+
+def test_shard_file_size_01(tmp_path):
+    """It reads the size of a small gzip file from its sample."""
+    data = b'>seq1\nACGTACGTAC\n' * 1000
+    path = tmp_path / 'reads.fasta.gz'
+    path.write_bytes(gzip.compress(data))
+    assert util.shard_file_size({}, str(path)) == len(data)
+
+
+def test_open_file_range_01(tmp_path):
+    """It reads only the records that start inside of the range."""
+    path = tmp_path / 'reads.fasta'
+    path.write_bytes(b'>seq1\nACGT\n>seq2\nACGT\n>seq3\nACGT\n')
+    with util.open_file_range(str(path), 3, 12, False) as stream:
+        assert stream.read() == '>seq2\nACGT\n'
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Build the atram databases for a batch of libraries with one worker pool."""
+
+import argparse
+import os
+import shlex
+import sys
+import textwrap
+
+import lib.db as db
+from atram_preprocessor import parse_command_line as parse_library
+from lib.core_preprocessor import preprocess_batch
+
+
+def parse_command_line():
+    """Process command-line arguments."""
+    description = """
+        This runs atram_preprocessor.py for many libraries at once while
+        sharing one pool of --cpus processes between them. A few libraries
+        are built at the same time so that one library's loading overlaps
+        with another one's blast DB builds.
+
+        The sheet has one library per line. Each line has the
+        atram_preprocessor.py arguments for that library, for example:
+
+            -b dbs/taxon_1 -1 taxon_1_R1.fastq.gz -2 taxon_1_R2.fastq.gz
+            -b dbs/taxon_2 -0 taxon_2.fastq.gz --shards 8
+
+        Blank lines and lines starting with "#" are skipped. Any other
+        atram_preprocessor.py arguments given here are used for every
+        library. The sequence files are always parsed in the worker
+        processes, like with --parallel-load.
+        """
+    parser = argparse.ArgumentParser(
+        fromfile_prefix_chars='@',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent(description))
+
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s {}'.format(db.ATRAM_VERSION))
+
+    parser.add_argument('sheet', metavar='SHEET',
+                        help="""The file listing the libraries.""")
+
+    cpus = min(10, os.cpu_count() - 4 if os.cpu_count() > 4 else 1)
+    parser.add_argument('--cpus', '--processes', '--max-processes',
+                        type=int, default=cpus,
+                        help="""Number of CPU threads to use for all of the
+                            libraries together. (default %(default)s)""")
+
+    parser.add_argument('--libraries', type=int, default=2, metavar='N',
+                        help="""How many libraries to build at the same
+                            time. The --batch-memory is split between them.
+                            (default %(default)s)""")
+
+    parser.add_argument('-l', '--log-file',
+                        help="""Log file (full path) for the batch. Each
+                            library logs to "<DB>.atram_preprocessor.log"
+                            unless its line has a --log-file.""")
+
+    parser.add_argument('--log-level', default='info',
+                        choices=['debug', 'info', 'error', 'fatal'],
+                        help="""Log messages of the given level (or above).
+                            (default %(default)s)""")
+
+    args, common = parser.parse_known_args()
+    args = vars(args)
+
+    if args['libraries'] < 1:
+        parser.error('--libraries must be at least 1.')
+
+    libraries = read_sheet(args, common)
+    if not libraries:
+        sys.exit('There are no libraries in "{}".'.format(args['sheet']))
+
+    args['libraries'] = min(args['libraries'], len(libraries))
+    for library in libraries:
+        library['cpus'] = args['cpus']
+        library['parallel_load'] = True
+        library['batch_memory'] = max(
+            1, library['batch_memory'] // args['libraries'])
+
+    return args, libraries
+
+
+def read_sheet(args, common):
+    """Get the preprocessor arguments for every library in the sheet."""
+    common = common + ['--log-level', args['log_level']]
+    libraries = []
+
+    with open(args['sheet']) as sheet:
+        for line_no, line in enumerate(sheet, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            try:
+                library = parse_library(common + shlex.split(line))
+            except SystemExit:
+                sys.exit('Error in line {} of "{}".'.format(
+                    line_no, args['sheet']))
+
+            if not library['log_file']:
+                library['log_file'] = '{}.atram_preprocessor.log'.format(
+                    library['blast_db'])
+            libraries.append(library)
+
+    return libraries
+
+
+if __name__ == '__main__':
+    ARGS, LIBRARIES = parse_command_line()
+    preprocess_batch(ARGS, LIBRARIES)
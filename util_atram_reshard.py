@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Rebuild the blast DB shards of an atram database with a new shard count."""
+
+import argparse
+import os
+import textwrap
+
+import lib.blast as blast
+import lib.db as db
+import lib.util as util
+from lib.core_preprocessor import reshard
+
+
+def parse_command_line():
+    """Process command-line arguments."""
+    description = """
+        This will rebuild the blast DB shards of an existing atram database
+        from the sequences in its SQLite database. Use it to change the
+        number of shards without loading the fasta or fastq files again.
+        The SQLite database is read once and the old shards are only
+        replaced after all of the new ones are built.
+        """
+    parser = argparse.ArgumentParser(
+        fromfile_prefix_chars='@',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent(description))
+
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s {}'.format(db.ATRAM_VERSION))
+
+    parser.add_argument('-b', '--blast-db', '--sra', '--db', '--database',
+                        required=True, metavar='DB',
+                        help="""This needs to match the DB prefix you
+                             entered for atram_preprocessor.py.""")
+
+    parser.add_argument('-s', '--shards', '--number', type=int,
+                        required=True, metavar='SHARDS', dest='shard_count',
+                        help="""Number of blast DB shards to create.""")
+
+    parser.add_argument('--shuffle', action='store_true',
+                        help="""Put the sequences into shards by a hash of
+                            their names instead of by name range.""")
+
+    cpus = min(10, os.cpu_count() - 4 if os.cpu_count() > 4 else 1)
+    parser.add_argument('--cpus', '--processes', '--max-processes',
+                        type=int, default=cpus,
+                        help="""Number of CPU threads to use.
+                            (default %(default)s)""")
+
+    parser.add_argument('-t', '--temp-dir', metavar='DIR',
+                        help="""Place temporary files in this directory. All
+                            files will be deleted after aTRAM completes. The
+                            directory must exist. It needs room for a copy of
+                            all of the sequences.""")
+
+    parser.add_argument('--keep-temp-dir', action='store_true',
+                        help="""This flag will keep the temporary files in
+                            the --temp-dir around for debugging.""")
+
+    parser.add_argument('-l', '--log-file', help="""Log file (full path).""")
+
+    parser.add_argument('--log-level', default='info',
+                        choices=['debug', 'info', 'error', 'fatal'],
+                        help="""Log messages of the given level (or above).
+                            (default %(default)s)""")
+
+    parser.add_argument('--path',
+                        help="""If makeblastdb is not in your $PATH then use
+                            this to prepend directories to your path.""")
+
+    args = vars(parser.parse_args())
+
+    if args['path']:
+        os.environ['PATH'] = '{}:{}'.format(args['path'], os.environ['PATH'])
+
+    args['blast_db'] = blast.touchup_blast_db_names([args['blast_db']])[0]
+
+    if args['shard_count'] < 1:
+        parser.error('--shards must be at least 1.')
+
+    blast.find_program('makeblastdb')
+
+    util.temp_dir_exists(args['temp_dir'])
+
+    return args
+
+
+if __name__ == '__main__':
+    ARGS = parse_command_line()
+    reshard(ARGS)